@@ -0,0 +1,230 @@
+"""An optional ASGI app that only resolves tags, for deployments
+where redirects outnumber the rest of the requests by far.
+
+It answers ``GET /{id}`` with the same semantics than
+:meth:`ereuse_tag.view.TagView.one`: ETag, Tag and secondary ids
+redirect to the linked device, tags without Devicehub get a 400
+``NoRemoteTag``, unknown ids a 404 and ETags of other providers
+a 422. It reads the database through a pool of `asyncpg
+<https://github.com/MagicStack/asyncpg>`_ connections, which prepare
+and keep the query of the redirects once per connection.
+
+Install it with ``pip install ereuse-tag[asgi]`` and serve it with
+the config of the Flask app::
+
+    # redirects.py
+    from app import DeviceTagConf
+    from ereuse_tag.asgi import create_app
+
+    app = create_app(DeviceTagConf())
+
+    $ uvicorn redirects:app --workers 4
+
+Put it behind the same proxy than the Flask app, sending it
+the ``GET`` and ``HEAD`` requests of tags.
+"""
+import asyncio
+import json
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, Mapping, Union
+
+import asyncpg
+from hashids import Hashids
+
+from ereuse_tag.cache import LRUCache
+from ereuse_tag.codec import Codec
+from ereuse_tag.config import TagsConfig
+from ereuse_tag.definition import TagDef
+from ereuse_tag.view import Redirect
+
+QUERY = '''SELECT t.id, t.type, GREATEST(t.updated, d.updated), t.frozen, d.url
+FROM tag t LEFT JOIN devicehub d ON d.id = t.devicehub_id
+WHERE t.secondary = $1 OR t.id = ANY($2::bigint[])
+ORDER BY t.id = ANY($2::bigint[]) DESC
+LIMIT 1'''
+"""The query of :meth:`ereuse_tag.model.Tag.find`, with the URL of
+the Devicehub and the last time the tag or its Devicehub changed."""
+
+
+class HTTPError(Exception):
+    """An error answered as the JSON errors of Teal."""
+
+    def __init__(self, code: int, type: str, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+        self.type = type
+        self.message = message
+
+    @property
+    def body(self) -> bytes:
+        return json.dumps({'message': self.message, 'code': self.code, 'type': self.type}).encode()
+
+
+class RedirectApp:
+    """The ASGI app. See the module.
+
+    :param dsn: The database URI, as ``SQLALCHEMY_DATABASE_URI``.
+    """
+
+    def __init__(self, dsn: str, provider_id: str, codec: Codec, max_age: int,
+                 frozen_max_age: int, cache_size: int = 0, cache_ttl: float = 0,
+                 min_size: int = 2, max_size: int = 10) -> None:
+        self.dsn = dsn
+        self.provider_id = provider_id
+        self.codec = codec
+        self.max_age = max_age
+        self.frozen_max_age = frozen_max_age
+        self.redirects = LRUCache(cache_size, cache_ttl)
+        self.min_size, self.max_size = min_size, max_size
+        self._pool = None  # type: asyncpg.pool.Pool
+        self._pool_lock = None  # type: asyncio.Lock
+
+    async def pool(self) -> 'asyncpg.pool.Pool':
+        """The pool of connections, created on the first call if
+        the server does not send the lifespan events.
+        """
+        if self._pool is None:
+            if self._pool_lock is None:  # Created here to bind it to the running loop
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size,
+                                                           max_size=self.max_size)
+        return self._pool
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def candidates(self, id: str) -> List[int]:
+        """Like :meth:`ereuse_tag.model.Tag.candidates`.
+
+        :raise HTTPError: The ETag belongs to another provider.
+        """
+        ids = []
+        parts = id.split('-')
+        if len(parts) == 2:
+            provider_id, hash = parts
+            if provider_id.lower() != self.provider_id.lower():
+                raise HTTPError(422, 'UnprocessableEntity',
+                                'The tag does not belong to this provider ID')
+            try:
+                ids.append(self.codec.decode(hash))
+            except ValueError:
+                pass
+        try:
+            ids.append(self.codec.decode(id))
+        except ValueError:
+            pass
+        return ids
+
+    async def resolve(self, id: str) -> Redirect:
+        """Resolves ``id`` as :meth:`ereuse_tag.view.TagView.one`.
+
+        :raise HTTPError: The tag does not exist, has no Devicehub
+                          or belongs to another provider.
+        """
+        cached = self.redirects.get(id)
+        if cached is not None:
+            return cached
+        ids = self.candidates(id)
+        pool = await self.pool()
+        async with pool.acquire() as connection:
+            row = await connection.fetchrow(QUERY, id, ids)
+        if row is None:
+            raise HTTPError(404, 'ResourceNotFound', 'The Tag doesn\'t exist.')
+        _id, type, updated, frozen, url = row
+        if url is None:
+            raise HTTPError(400, 'NoRemoteTag', 'This tag has not been assigned to a Devicehub.')
+        tag_id = self.codec.encode(_id)
+        if type == 'ETag':
+            tag_id = '{}-{}'.format(self.provider_id, tag_id)
+        cached = Redirect('{}/tags/{}/device'.format(url, tag_id), url, updated, frozen)
+        self.redirects.set(id, cached)
+        return cached
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.pool()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, send):
+        id = scope['path'].strip('/')
+        try:
+            if scope['method'] not in {'GET', 'HEAD'}:
+                raise HTTPError(405, 'MethodNotAllowed', 'Only GET and HEAD are allowed.')
+            if not id or '/' in id:
+                raise HTTPError(404, 'NotFound', 'The requested URL was not found.')
+            redirect = await self.resolve(id)
+        except HTTPError as e:
+            status, headers, body = e.code, [(b'content-type', b'application/json')], e.body
+        else:
+            status, headers = self.status(scope, redirect), self.headers(redirect)
+            body = b''
+        headers.append((b'content-length', str(len(body)).encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body',
+                    'body': body if scope['method'] != 'HEAD' else b''})
+
+    def status(self, scope, redirect: Redirect) -> int:
+        """304 if the client has ``redirect``, 302 otherwise.
+
+        As in Werkzeug, ``If-Modified-Since`` is only checked
+        without ``If-None-Match``.
+        """
+        headers = dict(scope.get('headers', ()))
+        if b'if-none-match' in headers:
+            value = headers[b'if-none-match'].decode('latin-1')
+            etags = {tag.strip().strip('"') for tag in value.split(',')}
+            return 304 if redirect.etag in etags or '*' in etags else 302
+        if b'if-modified-since' in headers:
+            try:
+                since = parsedate_to_datetime(headers[b'if-modified-since'].decode('latin-1'))
+            except (TypeError, ValueError):
+                return 302
+            # Last-Modified has no fractions of a second
+            if since.tzinfo is not None and redirect.updated.replace(microsecond=0) <= since:
+                return 304
+        return 302
+
+    def headers(self, redirect: Redirect) -> list:
+        max_age = self.frozen_max_age if redirect.frozen else self.max_age
+        return [
+            (b'location', redirect.location.encode()),
+            (b'cache-control', 'public, max-age={}'.format(max_age).encode()),
+            (b'etag', '"{}"'.format(redirect.etag).encode()),
+            (b'last-modified', format_datetime(redirect.updated, usegmt=True).encode())
+        ]
+
+
+def create_app(config: Union[TagsConfig, Mapping], **kwargs) -> RedirectApp:
+    """Creates the app from the config of the Flask app, either the
+    :class:`ereuse_tag.config.TagsConfig` or ``app.config``, passing
+    ``kwargs`` to :class:`RedirectApp`, like the size of the pool.
+    """
+    if not isinstance(config, Mapping):
+        config = {key: getattr(config, key) for key in dir(config) if key.isupper()}
+    hashids = Hashids(salt=config['TAG_HASH_SALT'], min_length=TagDef.TAG_HASH_MIN,
+                      alphabet=TagDef.TAG_HASH_ALPHABET)
+    kwargs.setdefault('cache_size', config['TAG_REDIRECT_CACHE_SIZE'])
+    kwargs.setdefault('cache_ttl', config['TAG_REDIRECT_CACHE_TTL'])
+    return RedirectApp(config['SQLALCHEMY_DATABASE_URI'], config['TAG_PROVIDER_ID'],
+                       Codec(hashids), config['TAG_REDIRECT_MAX_AGE'],
+                       config['TAG_FROZEN_MAX_AGE'], **kwargs)
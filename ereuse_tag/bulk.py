@@ -0,0 +1,341 @@
+"""Set-based operations over many tags at once.
+
+These functions work with plain SQL and the raw ids of the database,
+skipping the ORM, so their memory usage depends only on the size of
+the chunk they work with.
+"""
+import csv
+import datetime
+import io
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+from boltons.iterutils import chunked_iter
+from sqlalchemy import text
+
+from ereuse_tag import partitions
+from ereuse_tag.db import db
+
+CHUNK = 10000
+"""Default number of rows each statement works with."""
+
+
+def insert_tags(num: int, type: str, devicehub_id: int = None, chunk: int = CHUNK,
+                commit: bool = True) -> Iterator[List[int]]:
+    """Inserts ``num`` new tags of ``type``, ``chunk`` tags per
+    statement, yielding the (sorted) ids of each chunk.
+
+    Get ``devicehub_id`` with
+    :meth:`ereuse_tag.model.Devicehub.id_of`.
+
+    The ids are taken from ``tag_id_seq`` by the same statement
+    that inserts the tags, reserving the whole chunk at once.
+    Their partitions are created before if needed.
+
+    :param commit: Commit after each chunk. Otherwise the caller
+                   commits.
+    """
+    insert = text('INSERT INTO tag (id, type, devicehub_id) '
+                  'SELECT nextval(\'tag_id_seq\'), :type, :devicehub_id '
+                  'FROM generate_series(1, :num) '
+                  'RETURNING id')
+    last_value = db.session.execute('SELECT last_value FROM tag_id_seq').scalar()
+    partitions.ensure(db.session.connection(), last_value + num)
+    while num > 0:
+        n = min(num, chunk)
+        params = {'type': type, 'devicehub_id': devicehub_id, 'num': n}
+        result = db.session.execute(insert, params)
+        ids = sorted(id for id, in result)
+        if commit:
+            db.session.commit()
+        yield ids
+        num -= n
+
+
+def insert_links(urls: Iterable[str], chunk: int = CHUNK, commit: bool = True) \
+        -> Iterator[Tuple[List[str], List[int]]]:
+    """Inserts links to the ``urls`` that do not have one yet, ``chunk``
+    URLs per statement, yielding each chunk of URLs with their ids in
+    the same order, be them new or existing links.
+
+    Pass URLs normalized as ``URL(url).to_text()``, as
+    :class:`ereuse_tag.model.Link` saves them.
+
+    :param commit: Commit after each chunk. Otherwise the caller
+                   commits.
+    """
+    insert = text("""
+        WITH input AS (SELECT DISTINCT unnest(CAST(:urls AS VARCHAR[])) AS url),
+        new AS (
+            INSERT INTO link (id, url)
+            SELECT nextval('link_id_seq'), url FROM input
+            WHERE NOT EXISTS (SELECT 1 FROM link WHERE link.url = input.url)
+            ON CONFLICT (url) DO NOTHING
+            RETURNING id, url
+        )
+        SELECT id, url FROM new
+        UNION ALL
+        SELECT id, url FROM link WHERE url = ANY(CAST(:urls AS VARCHAR[]))
+    """)
+    select = text('SELECT id, url FROM link WHERE url = ANY(CAST(:urls AS VARCHAR[]))')
+    for urls in chunked_iter(urls, chunk):
+        ids = {url: id for id, url in db.session.execute(insert, {'urls': urls})}
+        missing = [url for url in urls if url not in ids]
+        if missing:  # Inserted by another transaction while this statement ran
+            ids.update((url, id) for id, url in db.session.execute(select, {'urls': missing}))
+        if commit:
+            db.session.commit()
+        yield urls, [ids[url] for url in urls]
+
+
+def update_devicehub(devicehub_id: int, start: int, end: int, freeze: bool = False,
+                     chunk: int = CHUNK, commit: bool = True) \
+        -> Iterator[Tuple[int, List[Tuple[int, str]]]]:
+    """Sets the Devicehub ``devicehub_id`` to the tags that are not
+    frozen and whose ids are between ``start`` and ``end``, both
+    inclusive.
+
+    Each chunk of ``chunk`` ids is updated with one statement,
+    yielding the last id of the chunk and the ids and types of the
+    updated tags.
+
+    :param freeze: Freeze the tags in this devicehub.
+    :param commit: Commit after each chunk. Otherwise the caller
+                   commits.
+    """
+    update = text('UPDATE tag SET devicehub_id = :devicehub_id, frozen = :freeze, '
+                  'updated = CURRENT_TIMESTAMP '
+                  'WHERE id BETWEEN :start AND :end AND NOT frozen '
+                  'RETURNING id, type')
+    for lo in range(start, end + 1, chunk):
+        hi = min(lo + chunk - 1, end)
+        params = {'devicehub_id': devicehub_id, 'freeze': freeze, 'start': lo, 'end': hi}
+        result = db.session.execute(update, params)
+        rows = sorted(tuple(row) for row in result)
+        if commit:
+            db.session.commit()
+        yield hi, rows
+
+
+def count_tags(start: int, end: int) -> int:
+    """Counts the tags that are not frozen and whose ids are between
+    ``start`` and ``end``, both inclusive.
+    """
+    return db.session.execute(text('SELECT count(*) FROM tag '
+                                   'WHERE id BETWEEN :start AND :end AND NOT frozen'),
+                              {'start': start, 'end': end}).scalar()
+
+
+def stream_tags(chunk: int = CHUNK, since: Union[datetime.datetime, str] = None) \
+        -> Iterator[List[tuple]]:
+    """Yields, in chunks, all the rows of the tag table ordered by id
+    as tuples of ``id``, ``secondary``, ``devicehub``, ``type``,
+    ``updated``, ``created``, ``frozen``, where ``devicehub`` is
+    the URL.
+
+    Rows are read through a server-side cursor, so only one chunk
+    is in memory at a time.
+
+    :param since: Only the tags updated, or whose Devicehub was
+                  updated, after this time. Strings are parsed
+                  by PostgreSQL.
+    """
+    connection = db.session.connection().execution_options(stream_results=True)
+    query = ('SELECT tag.id, secondary, devicehub.url, type, tag.updated, tag.created, '
+             'tag.frozen FROM tag LEFT JOIN devicehub ON devicehub.id = tag.devicehub_id')
+    params = {}
+    if since is not None:
+        # Two indexed selects instead of an OR over both tables
+        query = ('{0} WHERE tag.updated > CAST(:since AS TIMESTAMPTZ) '
+                 'UNION {0} WHERE devicehub.updated > CAST(:since AS TIMESTAMPTZ)'.format(query))
+        params['since'] = since
+    result = connection.execute(text(query + ' ORDER BY 1'), params)
+    yield from _fetch(result, chunk)
+
+
+def stream_secondaries(chunk: int = CHUNK) -> Iterator[List[Tuple[str, int]]]:
+    """Yields, in chunks, the secondary ids and database ids of
+    the tags that have both a secondary id and a Devicehub, ordered by
+    the code points of the secondary id.
+    """
+    connection = db.session.connection().execution_options(stream_results=True)
+    result = connection.execute(text('SELECT secondary, id FROM tag '
+                                     'WHERE secondary IS NOT NULL AND devicehub_id IS NOT NULL '
+                                     'ORDER BY secondary COLLATE "C"'))
+    yield from _fetch(result, chunk)
+
+
+def stream_secondary_ids(chunk: int = CHUNK, since: datetime.datetime = None) \
+        -> Iterator[List[str]]:
+    """Yields, in chunks, all the secondary ids, or only the ones
+    of the tags changed after ``since``.
+    """
+    connection = db.session.connection().execution_options(stream_results=True)
+    query = 'SELECT secondary FROM tag WHERE secondary IS NOT NULL'
+    params = {}
+    if since is not None:
+        query += ' AND updated > :since'
+        params['since'] = since
+    result = connection.execute(text(query), params)
+    for rows in _fetch(result, chunk):
+        yield [secondary for secondary, in rows]
+
+
+def _fetch(result, chunk: int) -> Iterator[list]:
+    try:
+        rows = result.fetchmany(chunk)
+        while rows:
+            yield rows
+            rows = result.fetchmany(chunk)
+    finally:
+        result.close()
+
+
+MERGE = ('ON CONFLICT (id) DO UPDATE SET secondary = EXCLUDED.secondary, '
+         'devicehub_id = EXCLUDED.devicehub_id, type = EXCLUDED.type, '
+         'updated = EXCLUDED.updated, created = EXCLUDED.created, frozen = EXCLUDED.frozen')
+
+
+def copy_tags(rows: Iterable[tuple], chunk: int = CHUNK, truncate: bool = True,
+              merge: bool = False) -> Iterator[int]:
+    """Copies ``rows``, tuples of ``id``, ``secondary``,
+    ``devicehub``, ``type``, ``updated``, ``created`` and optionally
+    ``frozen``, where ``id`` is the database id and ``devicehub``
+    the URL, into the tag table, yielding the number of rows of each
+    chunk once they are in it. Rows without ``frozen`` are not frozen.
+
+    Each chunk is loaded into a staging table through
+    ``COPY FROM STDIN`` and then moved to the tag table with
+    one statement, adding the Devicehubs that do not exist.
+    ``tag_id_seq`` is reset to follow the greatest id.
+
+    This does not commit: commit after each chunk to keep the
+    chunks done, or at the end to leave the table untouched
+    on failure.
+
+    :param truncate: Replace the contents of the tag table.
+    :param merge: Replace the tags that already exist instead of
+                  failing, as when loading an export of the tags
+                  changed since a time.
+    """
+    if truncate:
+        db.session.execute('TRUNCATE TABLE tag RESTART IDENTITY')
+    for batch in chunked_iter(rows, chunk):
+        db.session.execute('CREATE TEMPORARY TABLE IF NOT EXISTS tag_import (id BIGINT, '
+                           'secondary VARCHAR, devicehub VARCHAR, type VARCHAR, '
+                           'updated TIMESTAMPTZ, created TIMESTAMPTZ, frozen BOOLEAN) '
+                           'ON COMMIT DROP')
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(row if len(row) > 6 else (*row, False) for row in batch)
+        buffer.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert('COPY tag_import (id, secondary, devicehub, type, updated, created, '
+                           'frozen) FROM STDIN WITH CSV', buffer)
+        first, last = db.session.execute('SELECT MIN(id), MAX(id) FROM tag_import').first()
+        partitions.ensure(db.session.connection(), last, first)
+        db.session.execute('INSERT INTO devicehub (url) '
+                           'SELECT DISTINCT devicehub FROM tag_import '
+                           'WHERE devicehub IS NOT NULL '
+                           'ON CONFLICT (url) DO NOTHING')
+        db.session.execute('INSERT INTO tag (id, secondary, devicehub_id, type, updated, created, '
+                           'frozen) '
+                           'SELECT i.id, i.secondary, d.id, i.type, i.updated, i.created, '
+                           'COALESCE(i.frozen, false) '
+                           'FROM tag_import i LEFT JOIN devicehub d ON d.url = i.devicehub '
+                           + (MERGE if merge else ''))
+        db.session.execute('TRUNCATE TABLE tag_import')
+        db.session.execute('SELECT setval(\'tag_id_seq\', COALESCE(MAX(id), 0) + 1, false) '
+                           'FROM tag')
+        yield len(batch)
+
+
+INVALID_ID = 'invalid id'
+MISSING_SECONDARY = 'missing secondary id'
+UNKNOWN_ID = 'unknown id'
+DUPLICATE_ID = 'id with several secondary ids'
+DUPLICATE_SECONDARY = 'secondary id for several ids'
+CONFLICTING_SECONDARY = 'secondary id of another tag'
+OTHER_SECONDARY = 'tag with another secondary id'
+
+SecondaryProblem = Tuple[int, str, str, str]
+"""Number of the pairing, starting at 1, id, secondary id and
+the problem."""
+
+
+def set_secondaries(pairs: Iterable[Tuple[str, str]], decode: Callable[[str], Optional[int]],
+                    devicehub_id: int = None, chunk: int = CHUNK) \
+        -> Tuple[List[int], List[SecondaryProblem]]:
+    """Sets secondary ids to tags from ``pairs`` of tag id (a Tag or
+    ETag id) and secondary id, all at once.
+
+    The pairings are decoded and copied by chunks into a staging
+    table. Then, the pairings with problems are marked, and the rest
+    are set with one ``UPDATE ... FROM`` statement. A pairing is
+    rejected if its id is invalid or unknown, if the input pairs
+    the id or the secondary id with different ones, if the secondary
+    id belongs to another tag or if the tag has another secondary id.
+
+    The secondary ids of the tags are checked here, under
+    :data:`ereuse_tag.partitions.LOCK_SECONDARIES`, instead of by
+    the trigger.
+
+    This does not commit.
+
+    :param decode: Gets the database id of an id, or ``None``.
+    :param devicehub_id: Only set tags of this Devicehub or without
+                         Devicehub; the rest are unknown.
+    :return: The database ids of the tags that changed, and the
+             rejected pairings in the order of ``pairs``.
+    """
+    db.session.execute('CREATE TEMPORARY TABLE secondary_import (line BIGINT, id BIGINT, '
+                       'tag VARCHAR, secondary VARCHAR, problem VARCHAR) ON COMMIT DROP')
+    cursor = db.session.connection().connection.cursor()
+    for batch in chunked_iter(enumerate(pairs, 1), chunk):
+        rows = []
+        for line, (tag, secondary) in batch:
+            _id = decode(tag)
+            problem = None
+            if _id is None:
+                problem = INVALID_ID
+            elif not secondary:
+                problem = MISSING_SECONDARY
+            rows.append((line, _id, tag, secondary or None, problem))
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor.copy_expert('COPY secondary_import (line, id, tag, secondary, problem) '
+                           'FROM STDIN WITH CSV', buffer)
+    db.session.execute('ANALYZE secondary_import')
+    db.session.execute(partitions.LOCK_SECONDARIES)
+    db.session.execute(partitions.SKIP_UNIQUE_SECONDARY)
+    known = 'NOT EXISTS (SELECT 1 FROM tag t WHERE t.id = s.id)'
+    if devicehub_id is not None:
+        known = 'NOT EXISTS (SELECT 1 FROM tag t WHERE t.id = s.id ' \
+                'AND (t.devicehub_id IS NULL OR t.devicehub_id = :devicehub_id))'
+    checks = (
+        (UNKNOWN_ID, known),
+        (DUPLICATE_ID, 's.id IN (SELECT id FROM secondary_import WHERE problem IS NULL '
+                       'GROUP BY id HAVING count(DISTINCT secondary) > 1)'),
+        (DUPLICATE_SECONDARY, 's.secondary IN (SELECT secondary FROM secondary_import '
+                              'WHERE problem IS NULL '
+                              'GROUP BY secondary HAVING count(DISTINCT id) > 1)'),
+        (CONFLICTING_SECONDARY, 'EXISTS (SELECT 1 FROM tag t '
+                                'WHERE t.secondary = s.secondary AND t.id <> s.id)'),
+        (OTHER_SECONDARY, 'EXISTS (SELECT 1 FROM tag t WHERE t.id = s.id '
+                          'AND t.secondary IS NOT NULL AND t.secondary <> s.secondary)')
+    )
+    for problem, condition in checks:
+        db.session.execute(text('UPDATE secondary_import s SET problem = :problem '
+                                'WHERE s.problem IS NULL AND ' + condition),
+                           {'problem': problem, 'devicehub_id': devicehub_id})
+    result = db.session.execute('UPDATE tag t SET secondary = s.secondary, '
+                                'updated = CURRENT_TIMESTAMP '
+                                'FROM (SELECT DISTINCT id, secondary FROM secondary_import '
+                                '      WHERE problem IS NULL) s '
+                                'WHERE t.id = s.id AND t.secondary IS DISTINCT FROM s.secondary '
+                                'RETURNING t.id')
+    ids = [_id for _id, in result]
+    db.session.execute("SET LOCAL tag.bulk_secondaries = 'off'")
+    problems = db.session.execute('SELECT line, tag, secondary, problem FROM secondary_import '
+                                  'WHERE problem IS NOT NULL ORDER BY line').fetchall()
+    db.session.execute('DROP TABLE secondary_import')
+    return ids, [tuple(problem) for problem in problems]
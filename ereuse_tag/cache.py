@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Set
+
+
+class LRUCache:
+    """A bounded and thread-safe Least Recently Used cache whose
+    entries expire after ``ttl`` seconds.
+
+    It counts ``hits`` and ``misses`` so you can check how effective
+    the cache is.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value, time.monotonic() + self.ttl
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._pop(next(iter(self._data)))
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _pop(self, key: Hashable):
+        """Removes the key. Override to keep extra indexes in sync."""
+        return self._data.pop(key)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+
+class RedirectCache(LRUCache):
+    """Maps scanned ids (the Tag id, the ETag id or the secondary id)
+    to the final redirect location of their tag, or to any value
+    derived from it.
+
+    Entries are indexed by the database id of the tag too, so changing
+    a tag invalidates all the ids it was scanned with.
+
+    The cache lives in the process; other processes (i.e. the CLI or
+    other workers) invalidate it through :mod:`ereuse_tag.invalidation`,
+    and ``ttl`` bounds how long it is stale if they cannot.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        super().__init__(maxsize, ttl)
+        self._keys = {}  # type: Dict[int, Set[Hashable]]
+
+    def set(self, key: Hashable, value, _id: int = None):
+        with self._lock:
+            super().set(key, (value, _id))
+            if key in self._data:
+                self._keys.setdefault(_id, set()).add(key)
+
+    def get(self, key: Hashable, default=None):
+        value = super().get(key)
+        return default if value is None else value[0]
+
+    def invalidate(self, *ids: int):
+        """Removes the cached locations of the tags with the
+        given database ids.
+        """
+        with self._lock:
+            for _id in ids:
+                for key in self._keys.pop(_id, ()):
+                    self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._keys.clear()
+
+    def _pop(self, key: Hashable):
+        value = super()._pop(key)
+        keys = self._keys.get(value[0][1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[value[0][1]]
+        return value
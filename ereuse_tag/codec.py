@@ -0,0 +1,136 @@
+from functools import lru_cache
+from typing import Iterable, List
+
+from hashids import Hashids
+
+
+class Codec:
+    """Encodes database ids into the hashids that users see and
+    decodes them back, producing exactly the same output than
+    :class:`hashids.Hashids` for single values.
+
+    Tags always encode one value, so the alphabet that hashids
+    shuffles for each of the possible *lottery* characters is computed
+    once here, and encoding becomes a change of base. The last
+    ``memo`` encoded and decoded ids are memoized.
+
+    Hashids with more than one value, or anything the fast path does
+    not understand, are left to ``hashids``.
+    """
+
+    def __init__(self, hashids: Hashids, memo: int = 2 ** 16) -> None:
+        self.hashids = hashids
+        self._alphabet = alphabet = hashids._alphabet
+        self._separators = frozenset(hashids._separators)
+        self._guards = hashids._guards
+        self._min_length = hashids._min_length
+        salt = hashids._salt
+        # The alphabet hashids uses after picking each lottery character
+        self._alphabets = tuple(_reorder(alphabet, (lottery + salt + alphabet)[:len(alphabet)])
+                                for lottery in alphabet)
+        self._indexes = {lottery: {c: i for i, c in enumerate(a)}
+                         for lottery, a in zip(alphabet, self._alphabets)}
+        self.encode = lru_cache(maxsize=memo)(self._encode)
+        self.decode = lru_cache(maxsize=memo)(self._decode)
+
+    def _encode(self, _id: int) -> str:
+        """Encodes the database id ``_id``."""
+        if _id < 0:
+            raise ValueError('{} is not a valid id.'.format(_id))
+        values_hash = _id % 100
+        lottery = values_hash % len(self._alphabet)
+        alphabet = self._alphabets[lottery]
+        encoded = self._alphabet[lottery] + _hash(_id, alphabet)
+        if len(encoded) < self._min_length:
+            encoded = self._ensure_length(encoded, alphabet, values_hash)
+        return encoded
+
+    def _decode(self, id: str) -> int:
+        """Decodes ``id`` into its database id.
+
+        :raise ValueError: ``id`` is not a valid hashid.
+        """
+        if not id or not isinstance(id, str):
+            raise ValueError('{} is not a valid Tag.'.format(id))
+        parts = _split(id, self._guards)
+        hashid = parts[1] if 2 <= len(parts) <= 3 else parts[0]
+        indexes = self._indexes.get(hashid[:1])
+        if indexes is None or len(hashid) < 2 or self._separators.intersection(hashid):
+            return self._decode_slow(id)
+        _id = 0
+        length = len(indexes)
+        try:
+            for character in hashid[1:]:
+                _id = _id * length + indexes[character]
+        except KeyError:
+            raise ValueError('{} is not a valid Tag.'.format(id))
+        if self._encode(_id) != id:
+            raise ValueError('{} is not a valid Tag.'.format(id))
+        return _id
+
+    def _decode_slow(self, id: str) -> int:
+        res = self.hashids.decode(id)
+        if not res:
+            raise ValueError('{} is not a valid Tag.'.format(id))
+        return res[0]
+
+    def _ensure_length(self, encoded: str, alphabet: str, values_hash: int) -> str:
+        """Like hashids' ``_ensure_length``."""
+        guards = self._guards
+        encoded = guards[(values_hash + ord(encoded[0])) % len(guards)] + encoded
+        if len(encoded) < self._min_length:
+            encoded += guards[(values_hash + ord(encoded[2])) % len(guards)]
+        split_at = len(alphabet) // 2
+        while len(encoded) < self._min_length:
+            alphabet = _reorder(alphabet, alphabet)
+            encoded = alphabet[split_at:] + encoded + alphabet[:split_at]
+            excess = len(encoded) - self._min_length
+            if excess > 0:
+                start = excess // 2
+                encoded = encoded[start:start + self._min_length]
+        return encoded
+
+    def encode_many(self, ids: Iterable[int]) -> List[str]:
+        """Encodes several database ids."""
+        encode = self._encode
+        return [encode(_id) for _id in ids]
+
+    def decode_many(self, ids: Iterable[str]) -> List[int]:
+        """Decodes several hashids.
+
+        :raise ValueError: One of the ids is not a valid hashid.
+        """
+        decode = self.decode
+        return [decode(id) for id in ids]
+
+
+def _hash(number: int, alphabet: str) -> str:
+    hashed = []
+    length = len(alphabet)
+    while True:
+        number, position = divmod(number, length)
+        hashed.append(alphabet[position])
+        if not number:
+            return ''.join(reversed(hashed))
+
+
+def _reorder(string: str, salt: str) -> str:
+    """Shuffles ``string`` with ``salt`` as hashids does."""
+    if not salt:
+        return string
+    string = list(string)
+    index, integer_sum = 0, 0
+    for i in range(len(string) - 1, 0, -1):
+        integer = ord(salt[index])
+        integer_sum += integer
+        j = (integer + index + integer_sum) % i
+        string[i], string[j] = string[j], string[i]
+        index = (index + 1) % len(salt)
+    return ''.join(string)
+
+
+def _split(string: str, splitters: str) -> List[str]:
+    parts = [string]
+    for splitter in splitters:
+        parts = [p for part in parts for p in part.split(splitter)]
+    return parts
@@ -1,10 +1,12 @@
 import boltons.urlutils
-from decouple import config
+from decouple import Csv, config
 from itertools import chain
+from typing import List
 
 from teal.config import Config
 
-from ereuse_tag.definition import TagDef, VersionDef
+from ereuse_tag.definition import LinkDef, MetricsDef, ResolveDef, SecondaryDef, TagDef, \
+    VersionDef
 
 
 class TagsConfig(Config):
@@ -14,7 +16,17 @@ class TagsConfig(Config):
     DB_DATABASE = config('DB_DATABASE', 'tags')
     SQLALCHEMY_DATABASE_URI = 'postgresql://{user}:{pw}@{host}/{db}'.format(
         user=DB_USER, pw=DB_PASSWORD, host=DB_HOST, db=DB_DATABASE)  #type: str
-    RESOURCE_DEFINITIONS = TagDef, VersionDef
+    SQLALCHEMY_REPLICA_URIS = config('DB_REPLICA_URIS', '', cast=Csv())  # type: List[str]
+    """
+    Optional. Database URIs of read-only replicas of the main
+    database. Scans are resolved in the replicas.
+    """
+    TAG_REPLICA_MAX_LAG = config('TAG_REPLICA_MAX_LAG', 5, cast=float)
+    """
+    Seconds a replica can be behind the main database before
+    scans stop using it.
+    """
+    RESOURCE_DEFINITIONS = TagDef, VersionDef, MetricsDef, ResolveDef, LinkDef, SecondaryDef
     TAG_PROVIDER_ID = None
     """
     The eReuse.org Tag Provider ID for this instance.
@@ -33,6 +45,109 @@ class TagsConfig(Config):
     the base url (scheme plus host) and keys are the token that
     identifies them.
     """
+    TAG_REDIRECT_CACHE_SIZE = config('TAG_REDIRECT_CACHE_SIZE', 10000, cast=int)
+    """
+    How many scanned ids keep in memory with their redirect
+    location. Set to 0 to disable the cache.
+    """
+    TAG_REDIRECT_CACHE_TTL = config('TAG_REDIRECT_CACHE_TTL', 60, cast=int)
+    """
+    Seconds a cached redirect is valid. Changes done from other
+    processes (like the CLI) invalidate the cache through
+    ``TAG_REDIRECT_LISTEN``, or are seen after this time.
+    """
+    TAG_REDIRECT_LISTEN = config('TAG_REDIRECT_LISTEN', True, cast=bool)
+    """
+    Listen in the web workers to the changes of other processes to
+    invalidate their caches, using a database connection per worker.
+    See :mod:`ereuse_tag.invalidation`.
+    """
+    TAG_REDIRECT_MAX_AGE = config('TAG_REDIRECT_MAX_AGE', 60, cast=int)
+    """
+    Seconds that clients and proxies can cache the redirect of a tag.
+    Redirects carry an ETag and a Last-Modified so clients can
+    revalidate them after this time.
+    """
+    TAG_FROZEN_MAX_AGE = config('TAG_FROZEN_MAX_AGE', 7 * 24 * 3600, cast=int)
+    """
+    Like ``TAG_REDIRECT_MAX_AGE`` for frozen tags, whose Devicehub
+    does not change anymore.
+    """
+    TAG_LOOKUP_FILTER = config('TAG_LOOKUP_FILTER', False, cast=bool)
+    """
+    Reject scans of ids that cannot be tags without querying the
+    database. See :mod:`ereuse_tag.lookup`.
+    """
+    TAG_LOOKUP_FILTER_REFRESH = config('TAG_LOOKUP_FILTER_REFRESH', 10, cast=float)
+    """
+    Seconds between reads of the new tags and secondary ids for
+    ``TAG_LOOKUP_FILTER``. Tags created or given a secondary id from
+    other processes (like the CLI) can be not found until then.
+    """
+    TAG_NEGATIVE_CACHE_SIZE = config('TAG_NEGATIVE_CACHE_SIZE', 10000, cast=int)
+    """
+    How many scanned ids that were not found keep in memory with
+    ``TAG_LOOKUP_FILTER``, for ``TAG_REDIRECT_CACHE_TTL`` seconds.
+    """
+    TAG_POST_MAX = config('TAG_POST_MAX', 100000, cast=int)
+    """
+    The maximum number of tags a Devicehub can create in one request.
+    """
+    TAG_RESOLVE_MAX = config('TAG_RESOLVE_MAX', 1000, cast=int)
+    """
+    The maximum number of ids a Devicehub can resolve in one request.
+    """
+    TAG_SECONDARIES_MAX = config('TAG_SECONDARIES_MAX', 100000, cast=int)
+    """
+    The maximum number of secondary ids a Devicehub can set in one
+    request.
+    """
+    TAG_LINKS_MAX = config('TAG_LINKS_MAX', 100000, cast=int)
+    """
+    The maximum number of links a Devicehub can create in one request.
+    """
+    TAG_DELIVERY = config('TAG_DELIVERY', False, cast=bool)
+    """
+    Queue the tags set to the Devicehubs in ``DEVICEHUBS`` so
+    ``deliver-tags`` sends them. See :mod:`ereuse_tag.delivery`.
+    """
+    TAG_DELIVERY_BATCH = config('TAG_DELIVERY_BATCH', 5000, cast=int)
+    """
+    The maximum number of tags sent to a Devicehub in one request.
+    """
+    TAG_DELIVERY_WORKERS = config('TAG_DELIVERY_WORKERS', 8, cast=int)
+    """
+    How many Devicehubs ``deliver-tags`` sends tags to at the same time.
+    """
+    TAG_DELIVERY_TIMEOUT = config('TAG_DELIVERY_TIMEOUT', 30, cast=float)
+    """
+    Seconds to wait for a Devicehub to start answering.
+    """
+    TAG_DELIVERY_RETRIES = config('TAG_DELIVERY_RETRIES', 2, cast=int)
+    """
+    Times a request that fails for a connection error or a 5xx is
+    repeated right away before leaving the tags for later.
+    """
+    TAG_DELIVERY_BACKOFF = config('TAG_DELIVERY_BACKOFF', 60, cast=int)
+    """
+    Seconds before sending again tags that failed, doubled at each
+    attempt up to ``TAG_DELIVERY_MAX_BACKOFF``.
+    """
+    TAG_DELIVERY_MAX_BACKOFF = config('TAG_DELIVERY_MAX_BACKOFF', 3600, cast=int)
+    """
+    Maximum seconds between attempts to send tags to a Devicehub that
+    keeps failing.
+    """
+    TAG_PROFILE_SQL = config('TAG_PROFILE_SQL', False, cast=bool)
+    """
+    Count the SQL statements of each request and CLI command, adding
+    their time in a ``Server-Timing`` header. Meant for staging.
+    """
+    TAG_SLOW_QUERY_MS = config('TAG_SLOW_QUERY_MS', 100, cast=int)
+    """
+    When profiling, log the statements that take longer than these
+    milliseconds.
+    """
     API_DOC_CONFIG_TITLE = 'Tags'
     API_DOC_CONFIG_VERSION = '0.1'
 
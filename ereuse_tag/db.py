@@ -1,3 +1,90 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
 from teal.db import SQLAlchemy
 
 db = SQLAlchemy(session_options={'autoflush': False})
+
+
+class ReplicaRouter:
+    """Gives sessions to read-only replicas of the main database.
+
+    Replicas that are more than ``max_lag`` seconds behind are not
+    used. The lag of a replica is checked at most every
+    ``check_every`` seconds. Replicas that are not streaming from
+    the main database, for example because their replication broke,
+    are infinitely behind, as they cannot know what they miss.
+
+    Use it only for reads that can fall back to the main database
+    (``db.session``), for example when the replica does not have
+    a row yet.
+    """
+    LAG = ('SELECT CASE '
+           'WHEN NOT pg_is_in_recovery() THEN 0 '
+           'WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = \'streaming\') '
+           'THEN NULL '
+           'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+           'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END')
+    """The lag in seconds, 0 if the database is not a replica and
+    ``NULL`` if it does not receive changes."""
+
+    def __init__(self, uris: List[str], max_lag: float, check_every: float = 5,
+                 connect_timeout: int = 2) -> None:
+        self.uris = uris
+        self.max_lag = max_lag
+        self.check_every = check_every
+        self.connect_timeout = connect_timeout
+        """Seconds to wait for a connection, as the lag is checked
+        while answering scans."""
+        self._engines = {}  # type: Dict[str, Engine]
+        self._lags = {}  # type: Dict[str, tuple]
+        self._lock = threading.Lock()
+
+    def engine(self, uri: str) -> Engine:
+        with self._lock:
+            if uri not in self._engines:
+                self._engines[uri] = create_engine(
+                    uri, pool_pre_ping=True,
+                    connect_args={'connect_timeout': self.connect_timeout})
+            return self._engines[uri]
+
+    def lag(self, uri: str) -> float:
+        """Seconds ``uri`` is behind the main database, or infinite
+        if it cannot be reached or does not receive changes.
+        """
+        lag, checked = self._lags.get(uri, (None, 0))
+        if time.monotonic() - checked > self.check_every:
+            try:
+                with self.engine(uri).connect() as connection:
+                    lag = connection.execute(self.LAG).scalar()
+                lag = float('inf') if lag is None else float(lag)
+            except Exception:
+                lag = float('inf')
+            self._lags[uri] = lag, time.monotonic()
+        return lag
+
+    def replica(self) -> Optional[str]:
+        """A random replica that is not too far behind, if any."""
+        uris = [uri for uri in self.uris if self.lag(uri) <= self.max_lag]
+        return random.choice(uris) if uris else None
+
+    @contextmanager
+    def session(self) -> Iterator[Optional[Session]]:
+        """A session in a replica, or ``None`` if there are no
+        suitable replicas.
+        """
+        uri = self.replica()
+        if uri is None:
+            yield None
+        else:
+            session = Session(bind=self.engine(uri), autoflush=False)
+            try:
+                yield session
+            finally:
+                session.close()
@@ -1,16 +1,28 @@
 import csv as csvm
+import datetime
+import gzip
+import time
+from contextlib import contextmanager
+from itertools import islice
 from pathlib import Path
-from typing import Callable, Iterable, Tuple
+from typing import Callable, Iterable, Iterator, Tuple
 
+from boltons.iterutils import chunked_iter
 from boltons.urlutils import URL
-from click import IntRange, argument, option
+from click import ClickException, IntRange, argument, confirm, option, progressbar
 from ereuse_utils import cli
 from hashids import Hashids
-from sqlalchemy import between
 from teal.resource import Converters, Resource, url_for_resource
 
-from ereuse_tag.model import ETag, Tag, db
-from ereuse_tag.view import TagView, VersionView
+from ereuse_tag import bulk, delivery, edge, invalidation, manufacturing, partitions, \
+    profiling
+from ereuse_tag.cache import LRUCache, RedirectCache
+from ereuse_tag.codec import Codec
+from ereuse_tag.db import ReplicaRouter
+from ereuse_tag.lookup import LookupFilter
+from ereuse_tag.model import Devicehub, ETag, Job, Link, Tag, db
+from ereuse_tag.view import LinkView, MetricsView, ResolveView, SecondaryView, TagView, \
+    VersionView
 
 
 class TagDef(Resource):
@@ -20,6 +32,12 @@ class TagDef(Resource):
     TAG_HASH_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
     TAG_HASH_MIN = 5
     CLI_PATH = cli.Path(dir_okay=False, writable=True)
+    DEVICEHUB_CACHE_SIZE = 1024
+    REPLACING_COMMANDS = 'import', 'detach-partition'
+    """Jobs that remove tags or load them without changing their
+    ``updated``, which incremental compiles of redirects miss."""
+    RESUME = option('--resume', is_flag=True,
+                    help='Continue the last unfinished run with the same arguments.')
 
     def __init__(self, app,
                  import_name=__package__,
@@ -32,103 +50,460 @@ class TagDef(Resource):
                  root_path=None):
         cli_commands = (
             (self.create_tags, 'create-tags'),
+            (self.manufacture_etags, 'manufacture-etags'),
+            (self.verify_etags, 'verify-etags'),
             (self.set_tags, 'set-tags'),
+            (self.move_devicehub, 'move-devicehub'),
+            (self.deliver_tags, 'deliver-tags'),
+            (self.set_secondaries, 'set-secondaries'),
             (self.export_tags, 'export'),
-            (self.import_tags, 'import')
+            (self.compile_redirects, 'compile-redirects'),
+            (self.import_tags, 'import'),
+            (self.list_partitions, 'partitions'),
+            (self.detach_partition, 'detach-partition')
         )
         super().__init__(app, import_name, static_folder, static_url_path, template_folder,
                          url_prefix, subdomain, url_defaults, root_path, cli_commands)
         self.hashids = Hashids(salt=app.config['TAG_HASH_SALT'],
                                min_length=self.TAG_HASH_MIN,
                                alphabet=self.TAG_HASH_ALPHABET)
+        self.codec = Codec(self.hashids)
+        """Encodes and decodes the ids of the tags. Use this
+        instead of ``hashids``.
+        """
+        self.redirects = RedirectCache(maxsize=app.config['TAG_REDIRECT_CACHE_SIZE'],
+                                       ttl=app.config['TAG_REDIRECT_CACHE_TTL'])
+        """The redirect locations of the last scanned tags."""
+        self.devicehubs = LRUCache(maxsize=self.DEVICEHUB_CACHE_SIZE,
+                                   ttl=app.config['TAG_REDIRECT_CACHE_TTL'])
+        """The redirect templates of the Devicehubs, by id, and the ids
+        of the Devicehubs, by URL.
+        """
+        self.replicas = ReplicaRouter(app.config['SQLALCHEMY_REPLICA_URIS'],
+                                      app.config['TAG_REPLICA_MAX_LAG'])
+        """Where scans are resolved."""
+        self.lookup = LookupFilter(refresh=app.config['TAG_LOOKUP_FILTER_REFRESH'],
+                                   negative_size=app.config['TAG_NEGATIVE_CACHE_SIZE'],
+                                   negative_ttl=app.config['TAG_REDIRECT_CACHE_TTL']) \
+            if app.config['TAG_LOOKUP_FILTER'] else None
+        """Rejects the scans of ids that cannot be tags, if enabled."""
+        self.listener = invalidation.Listener(app) if app.config['TAG_REDIRECT_LISTEN'] else None
+        """Invalidates the caches with the changes of other processes."""
+        if self.listener is not None:
+            app.before_request(self.listener.start)
+        profiling.init_app(app)
 
+    @RESUME
     @option('--csv',
             type=CLI_PATH,
             help='The path of a CSV file to save the IDs.')
     @option('--etag/--no-etag', default=False, help='Generate eTags instead of regular tags.')
     @argument('num', type=IntRange(1))
-    def create_tags(self, num: int, csv: Path, etag: bool):
+    def create_tags(self, num: int, csv: Path, etag: bool, resume: bool):
         """
         Creates NUM empty tags (only with the ID) and optionally saves
         a CSV of those new ids into a file.
         """
         T = ETag if etag else Tag
-        tags = tuple(T() for _ in range(num))
-        db.session.add_all(tags)
-        db.session.commit()
-        self.tags_to_csv(csv, tags)
+        arguments = {'num': num, 'etag': etag, 'csv': csv and str(csv)}
+        job = Job.start('create-tags', arguments, total=num, resume=resume)
+        with self.open_csv(csv, keep=job.done) as csv_writer, \
+                progressbar(length=num - job.done, label='Creating tags') as bar:
+            for ids in bulk.insert_tags(num - job.done, T.t, commit=False):
+                if csv_writer:
+                    csv_writer.writerows([url] for url in self.urls((id, T.t) for id in ids))
+                job.advance(len(ids))
+                db.session.commit()
+                bar.update(len(ids))
+        job.finish()
         print('Created all tags and saved them in the CSV {}'.format(csv))
 
+    @option('--gzip/--no-gzip', default=False, help='Compress the files with gzip.')
+    @option('--workers', type=IntRange(1), help='Number of processes. By default one per CPU.')
+    @option('--shards', type=IntRange(1), default=1, help='Number of files to split the tags in.')
+    @argument('directory', type=cli.Path(file_okay=False, writable=True))
+    @argument('num', type=IntRange(1))
+    def manufacture_etags(self, num: int, directory: Path, shards: int, workers: int, gzip: bool):
+        """
+        Creates NUM ETags and writes the files to manufacture them,
+        as for Tag IT Smart, in DIRECTORY: the SHARDS CSV files with
+        the ids and URLs of the tags, their SHA256SUMS and a manifest.
+        """
+        id_ranges = []
+        with progressbar(length=num, label='Reserving ids') as bar:
+            for ids in bulk.insert_tags(num, ETag.t):
+                id_ranges.extend(manufacturing.ranges(ids))
+                bar.update(len(ids))
+        with progressbar(length=num, label='Writing files') as bar:
+            manifest = manufacturing.generate(directory, id_ranges,
+                                              base_url=url_for_resource(Tag),
+                                              provider_id=self.app.config['TAG_PROVIDER_ID'],
+                                              salt=self.app.config['TAG_HASH_SALT'],
+                                              hash_min=self.TAG_HASH_MIN,
+                                              hash_alphabet=self.TAG_HASH_ALPHABET,
+                                              shards=shards,
+                                              workers=workers,
+                                              compress=gzip,
+                                              progress=bar.update)
+        print('Wrote {} ETags in {} files in {}'.format(manifest['tags'], len(manifest['shards']),
+                                                        directory))
+
+    @argument('directory', type=cli.Path(exists=True, file_okay=False))
+    def verify_etags(self, directory: Path):
+        """Checks the files in DIRECTORY from manufacture-etags
+        against their manifest.
+        """
+        problems = manufacturing.verify(directory)
+        for problem in problems:
+            print(problem)
+        if problems:
+            raise ClickException('The files are not valid.')
+        print('All files are valid.')
+
     @option('--csv',
             type=CLI_PATH,
             help='The path of a CSV file to save the tags that were set.')
+    @option('--dry-run', is_flag=True, help='Only count the tags that would be set.')
+    @option('--freeze', is_flag=True,
+            help='Make this the final Devicehub of the tags, letting clients cache them longer.')
+    @RESUME
     @argument('ending-tag', type=IntRange(2))
     @argument('starting-tag', type=IntRange(1))
     @argument('devicehub')
-    def set_tags(self, devicehub: str, starting_tag: int, ending_tag: int, csv: Path):
+    def set_tags(self, devicehub: str, starting_tag: int, ending_tag: int, csv: Path,
+                 dry_run: bool, freeze: bool, resume: bool):
         """
         "Sends" the tags to the specific devicehub,
         so they can only be linked in that devicehub.
 
-        Actual implementation does not send them but rather update the
-        internal database as it did send them. You will need to create
+        With ``TAG_DELIVERY``, the tags are queued for
+        ``deliver-tags`` to send them to the Devicehub, if it
+        is in ``DEVICEHUBS``. Otherwise you will need to create
         them manually in the destination devicehub.
 
-        This method in the future will probably actually (virtually)
-        send them.
+        Frozen tags are not set.
         """
         assert starting_tag < ending_tag
         assert URL(devicehub) and devicehub[-1] != '/', 'Provide a valid URL without leading slash'
-        tags = Tag.query.filter(between(Tag.id, starting_tag, ending_tag)).all()
-        for tag in tags:
-            tag.devicehub = devicehub
-        db.session.commit()
-        self.tags_to_csv(csv, tags)
+        if dry_run:
+            num = bulk.count_tags(starting_tag, ending_tag)
+            print('{} tags would be set to {}'.format(num, devicehub))
+            return
+        devicehub_id = Devicehub.id_of(devicehub)
+        arguments = {'devicehub': devicehub, 'start': starting_tag, 'end': ending_tag,
+                     'freeze': freeze, 'csv': csv and str(csv)}
+        job = Job.start('set-tags', arguments, total=ending_tag - starting_tag + 1, resume=resume)
+        previous = job.checkpoint.get('last', starting_tag - 1)
+        written = job.checkpoint.get('rows', 0)
+        with self.open_csv(csv, keep=written) as csv_writer, \
+                progressbar(length=ending_tag - previous, label='Setting tags') as bar:
+            updates = bulk.update_devicehub(devicehub_id, previous + 1, ending_tag, freeze,
+                                            commit=False)
+            for last, rows in updates:
+                if csv_writer:
+                    csv_writer.writerows([url] for url in self.urls(rows))
+                if rows:
+                    delivery.queue(devicehub_id, devicehub, previous + 1, last)
+                written += len(rows)
+                job.advance(last - previous, last=last, rows=written)
+                invalidation.invalidate(db.session, (id for id, _ in rows))
+                db.session.commit()
+                bar.update(last - previous)
+                previous = last
+        job.finish()
         print('All tags set to {}'.format(devicehub))
 
+    @option('--report',
+            type=CLI_PATH,
+            help='The path of a CSV file to save the rejected pairings and why.')
+    @option('--header', is_flag=True, help='Skip the first row of FILE.')
+    @argument('file', type=cli.Path(exists=True, dir_okay=False))
+    def set_secondaries(self, file: Path, header: bool, report: Path):
+        """Sets the secondary ids, like the ids of NFC chips, of the
+        tags in FILE, a CSV with rows of tag or ETag id and secondary id.
+
+        All the pairings are set at once, or none if the command fails.
+        Pairings with unknown ids or with secondary ids that are
+        repeated or belong to other tags are rejected.
+        """
+        with file.open(newline='') as f:
+            rows = csvm.reader(f)
+            if header:
+                next(rows, None)
+            pairs = ((row[0].strip(), row[1].strip() if len(row) > 1 else '')
+                     for row in rows if row)
+            ids, problems = bulk.set_secondaries(pairs, Tag.database_id)
+        invalidation.invalidate(db.session, ids)
+        db.session.commit()
+        with self.open_csv(report) as csv_writer:
+            if csv_writer:
+                csv_writer.writerows(problems)
+        counts = {}
+        for *_, problem in problems:
+            counts[problem] = counts.get(problem, 0) + 1
+        print('Set {} secondary ids. Rejected {} pairings.'.format(len(ids), len(problems)))
+        for problem, count in sorted(counts.items()):
+            print('  {}: {}'.format(problem, count))
+
+    @option('--force', is_flag=True, help='Move the Devicehub even if it has frozen tags.')
+    @argument('new')
+    @argument('old')
+    def move_devicehub(self, old: str, new: str, force: bool):
+        """Moves the Devicehub at OLD to the URL NEW, redirecting
+        all its tags there.
+
+        Devicehubs with frozen tags are not moved without --force,
+        as clients and proxies can keep redirecting the frozen tags
+        to OLD for TAG_FROZEN_MAX_AGE.
+        """
+        assert URL(new) and new[-1] != '/', 'Provide a valid URL without leading slash'
+        devicehub = Devicehub.query.filter_by(url=URL(old)).one()
+        frozen = Tag.query.filter_by(devicehub_id=devicehub.id, frozen=True).exists()
+        if not force and db.session.query(frozen).scalar():
+            raise ClickException('{} has frozen tags that clients may keep redirecting '
+                                 'to it for {} seconds. Use --force to move it anyway.'
+                                 .format(old, self.app.config['TAG_FROZEN_MAX_AGE']))
+        devicehub.url = URL(new)
+        db.session.commit()
+        print('Moved {} to {}'.format(old, new))
+
+    @option('--watch', type=float,
+            help='Keep delivering, looking for new tags every these seconds.')
+    def deliver_tags(self, watch: float):
+        """Sends the queued tags to their Devicehubs, in batches and
+        to several Devicehubs at the same time.
+        See :mod:`ereuse_tag.delivery`.
+        """
+        while True:
+            results = delivery.deliver(self.app)
+            for url, delivered in sorted(results.items()):
+                print('Sent {} tags to {}{}'.format(delivered.tags, url,
+                                                    ': ' + delivered.failed
+                                                    if delivered.failed else ''))
+            if not watch:
+                break
+            time.sleep(watch)
+        if any(delivered.failed for delivered in results.values()):
+            raise ClickException('Some Devicehubs failed; their tags will be sent again.')
+
     @staticmethod
-    def tags_to_csv(path: Path, tags: Iterable[Tag]):
+    @contextmanager
+    def open_csv(path: Path = None, compress: bool = False, keep: int = None):
+        """Opens a CSV writer in ``path``, or gives ``None`` if
+        there is no path.
+
+        :param compress: Write the file compressed with gzip.
+        :param keep: For jobs: keep the first ``keep`` rows of the
+                     file, the ones of committed chunks, and append
+                     after them. Rows are written line by line, so
+                     the ones of a committed chunk are not lost if
+                     the command crashes.
         """
-        Generates tags
-        :param path:
-        :param tags:
-        :return:
+        if path is None:
+            yield None
+        elif keep is None:
+            with gzip.open(str(path), 'wt') if compress else path.open('w') as f:
+                yield csvm.writer(f)
+        else:
+            assert not compress, 'Jobs cannot write compressed CSVs'
+            with path.open('a+b') as f:
+                f.seek(0)
+                for _ in range(keep):
+                    f.readline()
+                f.truncate(f.tell())
+            with path.open('a', buffering=1) as f:
+                yield csvm.writer(f)
+
+    def urls(self, tags: Iterable[Tuple[int, str]]) -> Iterable[str]:
+        """Generates the URLs of tags given as pairs of database id
+        and type.
+
+        The base URL is computed once instead of calling
+        ``url_for_resource`` per tag.
         """
-        with path.open('w') as f:
-            csv_writer = csvm.writer(f)
-            for tag in tags:
-                csv_writer.writerow([url_for_resource(Tag, tag.id)])
+        base = url_for_resource(Tag)
+        etag = '{}{}-'.format(base, self.app.config['TAG_PROVIDER_ID'])
+        encode = self.codec.encode
+        for _id, type in tags:
+            yield (etag if type == ETag.t else base) + encode(_id)
 
+    @option('--since',
+            help='Export only the tags changed after this time (e.g. 2020-10-06T17:46:01+00:00), '
+                 'or after the previous export to the same CSV with "last".')
+    @option('--gzip/--no-gzip', default=False, help='Compress the CSV with gzip.')
     @argument('csv', type=CLI_PATH)
-    def export_tags(self, csv: Path):
+    def export_tags(self, csv: Path, gzip: bool, since: str):
         """Exports the Tag database in a CSV file.  The rows are:
-        ``id``, ``secondary``, ``devicehub``, ``type``, ``updated``, ``created``.
+        ``id``, ``secondary``, ``devicehub``, ``type``, ``updated``, ``created``,
+        ``frozen``.
+
+        Rows are streamed from the database and written as they come.
+
+        Each export records the time the database was read at, its
+        high-water mark, which ``--since last`` starts from.
+        Load exports with --since with ``import --merge``.
         """
-        with csv.open('w') as f:
-            csv_writer = csvm.writer(f)
-            for tag in Tag.query:
-                dh = tag.devicehub.to_url() if tag.devicehub else None
-                row = tag.id, tag.secondary, dh, tag.type, tag.updated, tag.created
-                csv_writer.writerow(row)
+        arguments = {'csv': str(csv)}
+        if since == 'last':
+            previous = Job.last('export', arguments)
+            if previous is None:
+                raise ClickException('There is no previous export to {}'.format(csv))
+            # Changes that were committed after the mark was read
+            since = datetime.datetime.fromtimestamp(previous.checkpoint['watermark'],
+                                                    datetime.timezone.utc) - edge.SAFETY
+        job = Job.start('export', arguments)
+        watermark = db.session.execute('SELECT CURRENT_TIMESTAMP').scalar()
+        etag = '{}-{{}}'.format(self.app.config['TAG_PROVIDER_ID'])
+        with self.open_csv(csv, compress=gzip) as csv_writer:
+            for rows in bulk.stream_tags(since=since):
+                ids = self.codec.encode_many(row[0] for row in rows)
+                csv_writer.writerows(
+                    # Rows are id, secondary, devicehub, type, updated, created, frozen
+                    (etag.format(id) if row[3] == ETag.t else id, *row[1:])
+                    for id, row in zip(ids, rows)
+                )
+                job.advance(len(rows))
+        job.advance(0, watermark=watermark.timestamp(), since=since and str(since))
+        job.finish()
+        print('Exported {} tags. The high-water mark is {}'.format(job.done,
+                                                                   watermark.isoformat()))
+
+    @option('--nginx', type=CLI_PATH, help='Write also an nginx map in this file.')
+    @option('--full', is_flag=True, help='Compile all the tags, not only the changed ones.')
+    @argument('map', type=CLI_PATH)
+    def compile_redirects(self, map: Path, nginx: Path, full: bool):
+        """Compiles the redirects of the tags into MAP, a file that
+        :mod:`ereuse_tag.edge` serves without the database.
 
+        If MAP exists, only the tags updated since it was compiled
+        are read from the database and merged into it, unless tags
+        were removed or imported meanwhile, which compiles all of them.
+        """
+        salt = self.app.config['TAG_HASH_SALT']
+        watermark = db.session.execute('SELECT CURRENT_TIMESTAMP').scalar()
+        old = None if full or not map.exists() else edge.RedirectMap(map)
+        if old and Job.query.filter(Job.command.in_(self.REPLACING_COMMANDS),
+                                    Job.updated > old.watermark - edge.SAFETY).count():
+            print('Tags were removed or imported since {}; compiling all of them.'.format(map))
+            old.close()
+            old = None
+        if old:
+            changed = [(id, dh, type == ETag.t, frozen, secondary)
+                       for rows in bulk.stream_tags(since=old.watermark - edge.SAFETY)
+                       for id, secondary, dh, type, _, _, frozen in rows]
+            tags = edge.merge_tags(old.tags(), (row[:4] for row in changed))
+            secondaries = edge.merge_secondaries(
+                old.secondaries(),
+                sorted((secondary, id) for id, dh, _, _, secondary in changed
+                       if secondary and dh),
+                {row[0] for row in changed}
+            )
+            print('Merging {} changed tags.'.format(len(changed)))
+        else:
+            tags = ((id, dh, type == ETag.t, frozen)
+                    for rows in bulk.stream_tags()
+                    for id, _, dh, type, _, _, frozen in rows if dh)
+            secondaries = (row for rows in bulk.stream_secondaries() for row in rows)
+        edge.write_map(map, tags, secondaries, watermark,
+                       provider_id=self.app.config['TAG_PROVIDER_ID'],
+                       hash_alphabet=self.TAG_HASH_ALPHABET,
+                       hash_min=self.TAG_HASH_MIN,
+                       devicehubs=old.devicehubs if old else ())
+        if old:
+            old.close()
+        redirects = edge.RedirectMap(map, salt)
+        if nginx:
+            edge.write_nginx_map(nginx, redirects)
+        print('Compiled {} tags and {} secondary ids into {}'.format(
+            redirects.num_tags, redirects.num_secondaries, map))
+        redirects.close()
+
+    @staticmethod
+    @contextmanager
+    def read_csv(path: Path):
+        """Opens a CSV reader of ``path``, which can be
+        gzip-compressed.
+        """
+        with path.open('rb') as f:
+            compressed = f.read(2) == b'\x1f\x8b'
+        with gzip.open(str(path), 'rt') if compressed else path.open() as f:
+            yield csvm.reader(f)
+
+    def decode_rows(self, rows: Iterable[list]) -> Iterator[tuple]:
+        """Decodes, in batches, the ids of rows from ``export``, with
+        or without the trailing ``frozen`` of older exports.
+        """
+        for batch in chunked_iter(rows, bulk.CHUNK):
+            ids = self.codec.decode_many(ETag.hash(id) if type == ETag.t else id
+                                         for id, _, _, type, *_ in batch)
+            for _id, (_, *row) in zip(ids, batch):
+                yield (_id, *row)
+
+    @option('--merge', is_flag=True,
+            help='Add and update the tags in CSV keeping the rest, as for exports with --since.')
+    @RESUME
     @argument('csv', type=CLI_PATH)
-    def import_tags(self, csv: Path):
-        """Imports the database from a CSV from ``export``.
-        This truncates only the Tag table.
-        """
-        db.session.execute('TRUNCATE TABLE {} RESTART IDENTITY'.format(Tag.__table__.name))
-        max_id = 0
-        """The maximum ID of the tags. Sequence is reset to this + 1."""
-        with csv.open() as f:
-            for row in csvm.reader(f):
-                id, secondary, dh, type, updated, created = row
-                cls = Tag if type == 'Tag' else ETag
-                dh = URL(dh) if dh else None
-                t = cls(id=id, secondary=secondary)
-                db.session.add(t)
-                max_id = max(max_id, cls.decode(id))
-        db.session.execute('ALTER SEQUENCE tag_id RESTART WITH {}'.format(max_id + 1))
-        db.session.commit()
+    def import_tags(self, csv: Path, resume: bool, merge: bool):
+        """Imports the database from a CSV from ``export``,
+        gzip-compressed or not.
+        This truncates only the Tag table, unless --merge.
+
+        Tags are imported and committed in chunks.
+        """
+        export = Job.last('export', {'csv': str(csv)})
+        if not merge and export is not None and export.checkpoint.get('since'):
+            raise ClickException('{} only has the tags changed since {} and importing it '
+                                 'would delete the rest. Use --merge.'
+                                 .format(csv, export.checkpoint['since']))
+        start = time.monotonic()
+        total = None
+        if not resume:
+            with self.read_csv(csv) as rows:
+                total = sum(1 for _ in rows)
+        job = Job.start('import', {'csv': str(csv), 'merge': merge}, total=total, resume=resume)
+        skip = job.done
+        with self.read_csv(csv) as rows, \
+                progressbar(length=job.total - skip, label='Importing tags') as bar:
+            for num in bulk.copy_tags(self.decode_rows(islice(rows, skip, None)),
+                                      truncate=not skip and not merge, merge=merge):
+                job.advance(num)
+                invalidation.clear(db.session)
+                db.session.commit()
+                bar.update(num)
+        job.finish()
+        num = job.done - skip
+        elapsed = time.monotonic() - start
+        print('Imported {} tags in {:.1f}s ({:.0f} tags/s).'.format(num, elapsed,
+                                                                   num / (elapsed or 1)))
+
+    def list_partitions(self):
+        """Lists the partitions of the tag table with their ranges of
+        ids, number of tags and number of tags without Devicehub.
+
+        Partitions whose tags all have a Devicehub and are not used
+        any more can be detached.
+        """
+        print('{:<12} {:>14} {:>14} {:>12} {:>12}'.format('partition', 'from', 'to', 'tags',
+                                                          'unset'))
+        for row in partitions.stats(db.session.connection()):
+            print('{:<12} {:>14} {:>14} {:>12} {:>12}'.format(*row))
+
+    @option('--yes', is_flag=True, help='Do not ask for confirmation.')
+    @argument('number', type=IntRange(0))
+    def detach_partition(self, number: int, yes: bool):
+        """Detaches the partition NUMBER from the tag table, keeping
+        it as a table you can archive and drop.
+
+        The tags of the partition stop redirecting.
+        """
+        if not yes:
+            confirm('Tags in {} will stop redirecting. Continue?'.format(partitions.name(number)),
+                    abort=True)
+        job = Job.start('detach-partition', {'number': number})
+        partitions.detach(db.session.connection(), number)
+        invalidation.clear(db.session)
+        job.finish()
+        print('Detached {}'.format(partitions.name(number)))
 
 
 class VersionDef(Resource):
@@ -155,3 +530,136 @@ class VersionDef(Resource):
 
         version_view = VersionView.as_view('VersionView', definition=self)
         self.add_url_rule('/version/', defaults=defaults, view_func=version_view, methods=get)
+
+
+class MetricsDef(Resource):
+    __type__ = 'Metrics'
+    SCHEMA = None
+    VIEW = None
+    AUTH = False
+
+    def __init__(self, app,
+                 import_name=__name__,
+                 static_folder=None,
+                 static_url_path=None,
+                 template_folder=None,
+                 url_prefix=None,
+                 subdomain=None,
+                 url_defaults=None,
+                 root_path=None,
+                 cli_commands: Iterable[Tuple[Callable, str or None]] = tuple()):
+        super().__init__(app, import_name, static_folder, static_url_path, template_folder,
+                         url_prefix, subdomain, url_defaults, root_path, cli_commands)
+        metrics_view = MetricsView.as_view('MetricsView', definition=self)
+        self.add_url_rule('/', view_func=metrics_view, methods={'GET'})
+
+
+class ResolveDef(Resource):
+    __type__ = 'Resolve'
+    SCHEMA = None
+    VIEW = None
+    AUTH = False  # The view authenticates by itself
+
+    def __init__(self, app,
+                 import_name=__name__,
+                 static_folder=None,
+                 static_url_path=None,
+                 template_folder=None,
+                 url_prefix=None,
+                 subdomain=None,
+                 url_defaults=None,
+                 root_path=None,
+                 cli_commands: Iterable[Tuple[Callable, str or None]] = tuple()):
+        super().__init__(app, import_name, static_folder, static_url_path, template_folder,
+                         url_prefix, subdomain, url_defaults, root_path, cli_commands)
+        resolve_view = ResolveView.as_view('ResolveView', definition=self)
+        self.add_url_rule('/', view_func=resolve_view, methods={'POST'})
+
+
+class LinkDef(Resource):
+    __type__ = 'Link'
+    SCHEMA = None
+    ID_CONVERTER = Converters.string
+    VIEW = LinkView
+
+    def __init__(self, app,
+                 import_name=__name__,
+                 static_folder=None,
+                 static_url_path=None,
+                 template_folder=None,
+                 url_prefix=None,
+                 subdomain=None,
+                 url_defaults=None,
+                 root_path=None):
+        cli_commands = (
+            (self.create_links, 'create-links'),
+        )
+        super().__init__(app, import_name, static_folder, static_url_path, template_folder,
+                         url_prefix, subdomain, url_defaults, root_path, cli_commands)
+        self.redirects = LRUCache(maxsize=app.config['TAG_REDIRECT_CACHE_SIZE'],
+                                  ttl=float('inf'))
+        """The URLs of the last visited links, which never change."""
+
+    @staticmethod
+    def normalize(url: str) -> str:
+        """``url`` as links save it.
+
+        :raise ValueError: ``url`` is not an absolute URL.
+        """
+        normalized = URL(url)
+        if not normalized.scheme or not normalized.host:
+            raise ValueError('{} is not an absolute URL.'.format(url))
+        return normalized.to_text()
+
+    def urls(self, ids: Iterable[int]) -> Iterator[str]:
+        """Generates the short URLs of the links with ``ids``."""
+        base = url_for_resource(Link)
+        encode = self.app.resources['Tag'].codec.encode
+        for _id in ids:
+            yield base + encode(_id)
+
+    @option('--csv',
+            type=TagDef.CLI_PATH,
+            help='The path of a CSV file to save the short URLs and their URLs.')
+    @argument('file', type=cli.Path(exists=True, dir_okay=False))
+    def create_links(self, file: Path, csv: Path):
+        """Creates links to the URLs in FILE, one per line.
+        URLs that already have a link keep it.
+        """
+        total = 0
+        with file.open() as f, TagDef.open_csv(csv) as csv_writer:
+            num = sum(1 for _ in f)
+            f.seek(0)
+            urls = (self.normalize(line.strip()) for line in f if line.strip())
+            with progressbar(length=num, label='Creating links') as bar:
+                try:
+                    for chunk, ids in bulk.insert_links(urls):
+                        if csv_writer:
+                            csv_writer.writerows(zip(self.urls(ids), chunk))
+                        total += len(ids)
+                        bar.update(len(ids))
+                except ValueError as e:
+                    raise ClickException('{} (the URLs before it have their links)'.format(e))
+        print('Created links to {} URLs'.format(total))
+
+
+class SecondaryDef(Resource):
+    __type__ = 'Secondary'
+    SCHEMA = None
+    VIEW = None
+    AUTH = False  # The view authenticates by itself
+
+    def __init__(self, app,
+                 import_name=__name__,
+                 static_folder=None,
+                 static_url_path=None,
+                 template_folder=None,
+                 url_prefix=None,
+                 subdomain=None,
+                 url_defaults=None,
+                 root_path=None,
+                 cli_commands: Iterable[Tuple[Callable, str or None]] = tuple()):
+        super().__init__(app, import_name, static_folder, static_url_path, template_folder,
+                         url_prefix, subdomain, url_defaults, root_path, cli_commands)
+        secondary_view = SecondaryView.as_view('SecondaryView', definition=self)
+        self.add_url_rule('/', view_func=secondary_view, methods={'POST'})
@@ -0,0 +1,158 @@
+"""Delivery of the tags set to Devicehubs.
+
+With ``TAG_DELIVERY``, ``set-tags`` and ``POST /tags`` queue the
+ranges of tags they set to a Devicehub of ``DEVICEHUBS`` in the
+outbox (:class:`ereuse_tag.model.Outbox`), in the same transaction
+than the tags. ``deliver-tags`` sends them afterwards.
+
+Each Devicehub gets ``POST {devicehub}/tags/`` requests, authenticated
+with its token, with a JSON array of up to ``TAG_DELIVERY_BATCH``
+tags, each one an object with its ``id``, ``type`` and ``secondary``.
+Any 2xx answer is a success. Requests carry an ``Idempotency-Key``
+header that is the same when a batch is sent again, for example
+after a timeout, so the Devicehub can ignore the batches it
+already has.
+
+Only the tags that are still set to the Devicehub when the batch
+is sent are sent, so a range set to another Devicehub meanwhile is
+not sent to the old one.
+
+Devicehubs are sent to at the same time, one thread each with its
+own pool of HTTP connections, and the batches of a Devicehub one
+after the other. An advisory lock keeps several ``deliver-tags`` from
+sending to the same Devicehub. If a Devicehub fails after the quick
+retries of ``TAG_DELIVERY_RETRIES``, its outbox waits an exponential
+backoff, and the rest of the Devicehubs are not affected.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from boltons.urlutils import URL
+from ereuse_utils.session import DevicehubClient, WrongStatus, retry
+from flask import Flask, current_app
+from requests import RequestException
+from sqlalchemy import text
+
+from ereuse_tag.model import Devicehub, Outbox, db
+
+LOCK = 0x646c76
+"""Advisory lock, with the id of the Devicehub, taken while
+sending to a Devicehub."""
+TAGS = text('SELECT id, type, secondary FROM tag '
+            'WHERE id BETWEEN :start AND :end AND devicehub_id = :devicehub_id '
+            'ORDER BY id LIMIT :limit')
+
+
+class Delivered(namedtuple('Delivered', 'tags failed')):
+    """The result of sending to a Devicehub: the number of tags sent
+    and the error that stopped it, if any.
+    """
+    __slots__ = ()
+
+
+def tokens(devicehubs: Dict[str, URL]) -> Dict[str, str]:
+    """The tokens of ``DEVICEHUBS`` by the URL, as text, of their
+    Devicehub.
+    """
+    return {url.to_text(): token for token, url in devicehubs.items()}
+
+
+def queue(devicehub_id: int, devicehub: URL, start: int, end: int):
+    """Queues the tags between ``start`` and ``end``, both inclusive,
+    if deliveries are enabled and ``devicehub`` is in ``DEVICEHUBS``.
+    """
+    config = current_app.config
+    if config['TAG_DELIVERY'] and URL(devicehub).to_text() in tokens(config['DEVICEHUBS']):
+        Outbox.add(devicehub_id, start, end)
+
+
+def deliver(app: Flask) -> Dict[str, Delivered]:
+    """Sends the due outbox to every Devicehub that has it.
+    Call it in an app context of ``app``.
+
+    :return: What was delivered by the URL of the Devicehub.
+    """
+    tokens_of = tokens(app.config['DEVICEHUBS'])
+    pending = db.session.query(Devicehub.id, Devicehub.url) \
+        .join(Outbox, Outbox.devicehub_id == Devicehub.id) \
+        .filter(Outbox.delivered.is_(None), Outbox.next_attempt <= db.func.now()) \
+        .distinct().all()
+    db.session.commit()
+    devicehubs = {url.to_text(): id for id, url in pending if url.to_text() in tokens_of}
+    if not devicehubs:
+        return {}
+    with ThreadPoolExecutor(min(app.config['TAG_DELIVERY_WORKERS'], len(devicehubs))) as pool:
+        futures = {url: pool.submit(deliver_devicehub, app, id, url, tokens_of[url])
+                   for url, id in devicehubs.items()}
+    return {url: future.result() for url, future in futures.items()}
+
+
+def deliver_devicehub(app: Flask, devicehub_id: int, url: str, token: str) -> Delivered:
+    """Sends the due outbox of a Devicehub, oldest first, stopping
+    at the first failure. Runs in its own thread.
+    """
+    config = app.config
+    with app.app_context():
+        with db.engine.connect() as lock:
+            if not lock.execute(text('SELECT pg_try_advisory_lock(:lock, :id)'),
+                                lock=LOCK, id=devicehub_id).scalar():
+                return Delivered(0, 'Another deliver-tags is sending to this Devicehub.')
+            try:
+                client = DevicehubClient(url, token=DevicehubClient.encode_token(token),
+                                         timeout=config['TAG_DELIVERY_TIMEOUT'])
+                retry(client, retries=config['TAG_DELIVERY_RETRIES'], backoff_factor=0.5,
+                      status_to_retry=(500, 502, 503, 504))
+                outbox = Outbox.query \
+                    .filter_by(devicehub_id=devicehub_id, delivered=None) \
+                    .filter(Outbox.next_attempt <= db.func.now()) \
+                    .order_by(Outbox.id).all()
+                sent = 0
+                for entry in outbox:
+                    try:
+                        sent += deliver_entry(client, entry, url)
+                    except (RequestException, WrongStatus) as e:
+                        db.session.rollback()
+                        entry.fail(str(e), config['TAG_DELIVERY_BACKOFF'],
+                                   config['TAG_DELIVERY_MAX_BACKOFF'])
+                        db.session.commit()
+                        return Delivered(sent, str(e))
+                return Delivered(sent, None)
+            finally:
+                lock.execute(text('SELECT pg_advisory_unlock(:lock, :id)'),
+                             lock=LOCK, id=devicehub_id)
+                db.session.remove()
+
+
+def deliver_entry(client: DevicehubClient, entry: Outbox, url: str) -> int:
+    """Sends the tags of ``entry`` in batches, committing after each
+    one where to continue.
+
+    :return: The number of tags sent.
+    """
+    codec = current_app.resources['Tag'].codec
+    provider_id = current_app.config['TAG_PROVIDER_ID']
+    batch = current_app.config['TAG_DELIVERY_BATCH']
+    sent = 0
+    while True:
+        rows = db.session.execute(TAGS, {'start': entry.done + 1, 'end': entry.end,
+                                         'devicehub_id': entry.devicehub_id,
+                                         'limit': batch}).fetchall()
+        if not rows:
+            break
+        ids = codec.encode_many(_id for _id, _, _ in rows)
+        tags = [{'id': '{}-{}'.format(provider_id, id) if type == 'ETag' else id,
+                 'type': type,
+                 'secondary': secondary}
+                for id, (_, type, secondary) in zip(ids, rows)]
+        key = '{}-{}-{}-{}'.format(provider_id, entry.id, rows[0][0], rows[-1][0])
+        client.post(url + '/tags/', tags, status=None, headers={'Idempotency-Key': key})
+        entry.done = rows[-1][0]
+        db.session.commit()
+        sent += len(rows)
+        if len(rows) < batch:
+            break
+    entry.delivered = db.func.now()
+    entry.error = None
+    db.session.commit()
+    return sent
@@ -0,0 +1,333 @@
+"""Redirect maps: the redirects of the tag table compiled into a
+file, so the edge can answer scans without the database.
+
+``compile-redirects`` writes the maps. Serve them with
+:class:`EdgeApp`, a tiny WSGI app that binary-searches the map::
+
+    $ TAG_MAP=/srv/tags.map TAG_HASH_SALT=... gunicorn 'ereuse_tag.edge:create_app()'
+
+Or ask ``compile-redirects`` for an nginx ``map`` file.
+
+A map file contains:
+
+1. A header (:data:`HEADER`) with the position of the other sections.
+2. The tags with a Devicehub, as fixed-size records (:data:`TAG`)
+   sorted by database id.
+3. The secondary ids, each one a :data:`SECONDARY` record followed by
+   the UTF-8 id, sorted by id.
+4. The offsets of the secondary ids, relative to the third section.
+5. A JSON object with the Devicehubs, the parameters of the hashids
+   (except the salt) and the time of the compilation.
+"""
+import datetime
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+from tempfile import TemporaryFile
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from decouple import config
+from hashids import Hashids
+
+from ereuse_tag.codec import Codec
+
+MAGIC = b'ETAGMAP1'
+HEADER = struct.Struct('<8sQQQQQQ')
+"""Magic, number of tags, number of secondary ids, and positions of
+the tags, secondary ids, secondary offsets and metadata sections."""
+TAG = struct.Struct('<QIB')
+"""Database id, index of the Devicehub and flags (:data:`ETAG`,
+:data:`FROZEN`)."""
+ETAG = 1
+FROZEN = 2
+SECONDARY = struct.Struct('<QH')
+"""Database id and length of the secondary id."""
+OFFSET = struct.Struct('<Q')
+SAFETY = datetime.timedelta(minutes=5)
+"""Changes committed up to this time after a compilation started
+are still picked by the next incremental compilation."""
+
+TagRow = Tuple[int, str, bool, bool]
+"""Database id, Devicehub, whether it is an ETag and whether it is
+frozen."""
+SecondaryRow = Tuple[str, int]
+"""Secondary id and database id."""
+
+
+class RedirectMap:
+    """A read-only, memory-mapped redirect map.
+
+    :param salt: The ``TAG_HASH_SALT``. Needed to encode and decode
+                 tag ids, not to iterate the map.
+    """
+
+    def __init__(self, path: Path, salt: str = None) -> None:
+        with Path(path).open('rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.num_tags, self.num_secondaries, self._tags_at, self._secondaries_at, \
+            self._offsets_at, meta_at = HEADER.unpack_from(self._mm)
+        assert magic == MAGIC, '{} is not a redirect map.'.format(path)
+        meta = json.loads(self._mm[meta_at:].decode())
+        self.devicehubs = meta['devicehubs']  # type: List[str]
+        self.provider_id = meta['provider_id']  # type: str
+        self.watermark = datetime.datetime.strptime(meta['watermark'], '%Y-%m-%dT%H:%M:%S.%f%z')
+        self.hash_min = meta['hash_min']
+        self.hash_alphabet = meta['hash_alphabet']
+        self.codec = None  # type: Codec
+        if salt is not None:
+            hashids = Hashids(salt=salt, min_length=self.hash_min, alphabet=self.hash_alphabet)
+            self.codec = Codec(hashids)
+
+    def tag(self, i: int) -> TagRow:
+        _id, devicehub, flags = TAG.unpack_from(self._mm, self._tags_at + i * TAG.size)
+        return _id, self.devicehubs[devicehub], bool(flags & ETAG), bool(flags & FROZEN)
+
+    def secondary(self, i: int) -> SecondaryRow:
+        offset, = OFFSET.unpack_from(self._mm, self._offsets_at + i * OFFSET.size)
+        at = self._secondaries_at + offset
+        _id, length = SECONDARY.unpack_from(self._mm, at)
+        at += SECONDARY.size
+        return self._mm[at:at + length].decode(), _id
+
+    def tags(self) -> Iterator[TagRow]:
+        return (self.tag(i) for i in range(self.num_tags))
+
+    def secondaries(self) -> Iterator[SecondaryRow]:
+        return (self.secondary(i) for i in range(self.num_secondaries))
+
+    def find_tag(self, _id: int) -> Optional[TagRow]:
+        lo, hi = 0, self.num_tags
+        while lo < hi:
+            mid = (lo + hi) // 2
+            tag = self.tag(mid)
+            if tag[0] < _id:
+                lo = mid + 1
+            elif tag[0] > _id:
+                hi = mid
+            else:
+                return tag
+        return None
+
+    def find_secondary(self, secondary: str) -> Optional[int]:
+        lo, hi = 0, self.num_secondaries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, _id = self.secondary(mid)
+            if key < secondary:
+                lo = mid + 1
+            elif key > secondary:
+                hi = mid
+            else:
+                return _id
+        return None
+
+    def tag_id(self, tag: TagRow) -> str:
+        """The id users see of ``tag``."""
+        _id, _, etag, _ = tag
+        encoded = self.codec.encode(_id)
+        return '{}-{}'.format(self.provider_id, encoded) if etag else encoded
+
+    def location(self, tag: TagRow) -> str:
+        """The redirect location of ``tag``, as
+        :attr:`ereuse_tag.model.Tag.remote_device`.
+        """
+        return '{}/tags/{}/device'.format(tag[1], self.tag_id(tag))
+
+    def resolve(self, id: str) -> Optional[str]:
+        """The redirect location of an ETag, Tag or secondary id,
+        with the same precedence as :meth:`ereuse_tag.model.Tag.resolve`,
+        or ``None`` if the map does not have it.
+        """
+        tag = self.resolve_tag(id)
+        return self.location(tag) if tag else None
+
+    def resolve_tag(self, id: str) -> Optional[TagRow]:
+        """Like :meth:`.resolve`, getting the tag."""
+        provider_id, _, hash = id.rpartition('-')
+        if provider_id and provider_id.lower() != self.provider_id.lower():
+            hash = None
+        if hash:
+            try:
+                tag = self.find_tag(self.codec.decode(hash))
+            except ValueError:
+                pass
+            else:
+                if tag:
+                    return tag
+        _id = self.find_secondary(id)
+        return self.find_tag(_id) if _id is not None else None
+
+    def close(self):
+        self._mm.close()
+
+
+def merge_tags(old: Iterable[TagRow],
+               changed: Iterable[Tuple[int, Optional[str], bool, bool]]) -> Iterator[TagRow]:
+    """Merges tags sorted by id, where ``changed`` replace ``old``.
+    Changed tags without Devicehub are removed.
+    """
+    old, changed = iter(old), iter(changed)
+    a, b = next(old, None), next(changed, None)
+    while a or b:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield a
+            a = next(old, None)
+        else:
+            if a is not None and a[0] == b[0]:
+                a = next(old, None)
+            if b[1]:
+                yield b
+            b = next(changed, None)
+
+
+def merge_secondaries(old: Iterable[SecondaryRow], changed: List[SecondaryRow],
+                      changed_ids: Set[int]) -> Iterator[SecondaryRow]:
+    """Merges secondary ids sorted by id, removing the old secondary
+    ids of the tags in ``changed_ids``.
+    """
+    old = (row for row in old if row[1] not in changed_ids)
+    a, b = next(old, None), 0
+    while a or b < len(changed):
+        if b == len(changed) or (a is not None and a[0] < changed[b][0]):
+            yield a
+            a = next(old, None)
+        else:
+            if a is not None and a[0] == changed[b][0]:
+                a = next(old, None)
+            yield changed[b]
+            b += 1
+
+
+def write_map(path: Path, tags: Iterable[TagRow], secondaries: Iterable[SecondaryRow],
+              watermark: datetime.datetime, provider_id: str, hash_alphabet: str,
+              hash_min: int, devicehubs: Iterable[str] = ()):
+    """Writes a redirect map in ``path``, replacing it atomically.
+
+    :param tags: Tags sorted by database id.
+    :param secondaries: Secondary ids sorted by id.
+    :param watermark: The database time when the reading of the
+                      tags started.
+    :param devicehubs: The Devicehubs of a previous version of the map,
+                       to keep their indexes.
+    """
+    devicehubs = list(devicehubs)
+    indexes = {devicehub: i for i, devicehub in enumerate(devicehubs)}
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    num_tags = num_secondaries = 0
+    with tmp.open('wb') as f, TemporaryFile() as offsets:
+        f.write(b'\0' * HEADER.size)
+        tags_at = f.tell()
+        for _id, devicehub, etag, frozen in tags:
+            if devicehub not in indexes:
+                indexes[devicehub] = len(devicehubs)
+                devicehubs.append(devicehub)
+            f.write(TAG.pack(_id, indexes[devicehub], etag * ETAG | frozen * FROZEN))
+            num_tags += 1
+        secondaries_at = f.tell()
+        for secondary, _id in secondaries:
+            offsets.write(OFFSET.pack(f.tell() - secondaries_at))
+            secondary = secondary.encode()
+            f.write(SECONDARY.pack(_id, len(secondary)))
+            f.write(secondary)
+            num_secondaries += 1
+        offsets_at = f.tell()
+        offsets.seek(0)
+        for chunk in iter(lambda: offsets.read(2 ** 20), b''):
+            f.write(chunk)
+        meta_at = f.tell()
+        f.write(json.dumps({
+            'devicehubs': devicehubs,
+            'provider_id': provider_id,
+            'watermark': watermark.strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
+            'hash_min': hash_min,
+            'hash_alphabet': hash_alphabet
+        }).encode())
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, num_tags, num_secondaries, tags_at, secondaries_at,
+                            offsets_at, meta_at))
+    os.replace(str(tmp), str(path))
+
+
+def write_nginx_map(path: Path, redirects: RedirectMap, variable: str = '$tag_redirect'):
+    """Writes an nginx ``map`` of request URIs to redirect locations
+    from a redirect map.
+
+    Use it like::
+
+        if ($tag_redirect) {
+            return 302 $tag_redirect;
+        }
+    """
+
+    def quote(value: str) -> str:
+        return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+    with Path(path).open('w') as f:
+        f.write('map $uri {} {{\n    default "";\n'.format(variable))
+        for tag in redirects.tags():
+            f.write('    {} {};\n'.format(quote('/' + redirects.tag_id(tag)),
+                                          quote(redirects.location(tag))))
+        for secondary, _id in redirects.secondaries():
+            tag = redirects.find_tag(_id)
+            if tag:
+                f.write('    {} {};\n'.format(quote('/' + secondary),
+                                              quote(redirects.location(tag))))
+        f.write('}\n')
+
+
+class EdgeApp:
+    """A WSGI app that answers redirects from a redirect map,
+    reloading the map when it is compiled again.
+
+    Ids that are not in the map get a 404, so a proxy in front can
+    send them to the main app. Frozen tags are cached for
+    ``frozen_max_age``, as in :meth:`ereuse_tag.view.TagView.one`.
+
+    The previous map is closed when it is reloaded, so serve the app
+    with workers of one thread, like the sync workers of gunicorn.
+    """
+
+    def __init__(self, path: Path, salt: str, max_age: int = 60,
+                 frozen_max_age: int = 7 * 24 * 3600) -> None:
+        self.path = Path(path)
+        self.salt = salt
+        self.max_age = max_age
+        self.frozen_max_age = frozen_max_age
+        self._mtime = None
+        self._map = None  # type: RedirectMap
+
+    @property
+    def map(self) -> RedirectMap:
+        mtime = self.path.stat().st_mtime_ns
+        if mtime != self._mtime:
+            old, self._map, self._mtime = self._map, RedirectMap(self.path, self.salt), mtime
+            if old is not None:
+                old.close()
+        return self._map
+
+    def __call__(self, environ, start_response):
+        id = environ.get('PATH_INFO', '').encode('latin-1').decode('utf-8', 'replace').strip('/')
+        redirects = self.map
+        tag = redirects.resolve_tag(id) if id and '/' not in id else None
+        if tag is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not found.']
+        start_response('302 Found', [
+            ('Location', redirects.location(tag)),
+            ('Cache-Control', 'public, max-age={}'.format(
+                self.frozen_max_age if tag[3] else self.max_age))
+        ])
+        return [b'']
+
+
+def create_app() -> EdgeApp:
+    """Creates the edge app from the ``TAG_MAP``, ``TAG_HASH_SALT``,
+    ``TAG_REDIRECT_MAX_AGE`` and ``TAG_FROZEN_MAX_AGE`` environment
+    variables.
+    """
+    return EdgeApp(config('TAG_MAP'), config('TAG_HASH_SALT'),
+                   config('TAG_REDIRECT_MAX_AGE', 60, cast=int),
+                   config('TAG_FROZEN_MAX_AGE', 7 * 24 * 3600, cast=int))
@@ -0,0 +1,170 @@
+"""Invalidation of the caches of redirects of every process.
+
+Changes to the redirects of tags are marked in the session that
+does them with :func:`invalidate` and :func:`clear`, which the
+listeners of :mod:`ereuse_tag.model` do for the ORM. When the session
+commits, the caches of the process are invalidated, and a
+``NOTIFY tag_redirects`` in the same transaction tells the rest of
+processes, like the web workers when the CLI changes tags.
+
+Web workers ``LISTEN`` through a :class:`Listener`, a thread with its
+own connection that is started with the first request. Notifications
+sent while the listener is disconnected are lost, so it clears the
+caches when it reconnects. ``TAG_REDIRECT_CACHE_TTL`` still bounds
+how long a lost notification keeps a redirect stale.
+"""
+import logging
+import select
+import threading
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+from flask import Flask
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from ereuse_tag import manufacturing
+from ereuse_tag.db import db
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'tag_redirects'
+CLEAR = '*'
+"""The payload that clears the caches."""
+MAX_PAYLOAD = 7000
+"""Characters of a notification, which PostgreSQL limits to 8000 bytes."""
+NOTIFY = text('SELECT pg_notify(:channel, :payload)')
+
+
+def invalidate(session: Session, ids: Iterable[int]):
+    """Invalidates the redirects of the tags with the database
+    ``ids`` once ``session`` commits.
+    """
+    session.info.setdefault('redirects', set()).update(ids)
+
+
+def clear(session: Session):
+    """Clears the caches of redirects and Devicehubs once ``session``
+    commits, as when a Devicehub moves or tags are removed.
+    """
+    session.info['devicehubs'] = True
+
+
+def pending(session: Session, pop: bool = False) -> Tuple[Set[int], bool]:
+    """The ids to invalidate and whether to clear the caches once
+    ``session`` commits.
+    """
+    get = session.info.pop if pop else session.info.get
+    return get('redirects', None) or set(), get('devicehubs', False)
+
+
+def payloads(ids: Iterable[int]) -> Iterator[str]:
+    """Packs ``ids`` into payloads of ranges like ``1-5,8``."""
+    payload = ''
+    for first, last in manufacturing.ranges(sorted(ids)):
+        part = str(first) if first == last else '{}-{}'.format(first, last)
+        if payload and len(payload) + len(part) >= MAX_PAYLOAD:
+            yield payload
+            payload = ''
+        payload += (',' if payload else '') + part
+    if payload:
+        yield payload
+
+
+def parse(payload: str) -> Optional[List[manufacturing.Range]]:
+    """The ranges of ids of a payload, or ``None`` if it clears."""
+    if payload == CLEAR:
+        return None
+    id_ranges = []
+    for part in payload.split(','):
+        first, _, last = part.partition('-')
+        id_ranges.append((int(first), int(last or first)))
+    return id_ranges
+
+
+def notify(session: Session):
+    """Sends the pending invalidations of ``session`` to the rest of
+    processes, in its transaction, so they only get them if it commits.
+    """
+    ids, clears = pending(session)
+    for payload in [CLEAR] if clears else payloads(ids):
+        session.execute(NOTIFY, {'channel': CHANNEL, 'payload': payload})
+
+
+class Listener:
+    """Invalidates the caches of the ``Tag`` resource of ``app`` with
+    the notifications of other processes. See the module.
+
+    :param reconnect: Seconds between attempts to connect.
+    :param poll: Seconds between checks of whether to stop.
+    """
+
+    def __init__(self, app: Flask, reconnect: float = 5, poll: float = 1) -> None:
+        self.app = app
+        self.reconnect = reconnect
+        self.poll = poll
+        self._thread = None  # type: threading.Thread
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        """Starts listening, if not already. Call it in the process
+        that serves requests, as threads do not survive a fork.
+        """
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self.run, name='tag-redirects',
+                                                    daemon=True)
+                    self._thread.start()
+
+    def stop(self):
+        """Stops listening, closing the connection, and waits for it."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+            self._stop.clear()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    engine = db.engine
+                with engine.connect() as connection:
+                    try:
+                        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+                        connection.execute(text('LISTEN {}'.format(CHANNEL)))
+                        self.apply(CLEAR)  # We do not know what we missed
+                        self.listen(connection.connection.connection)
+                    finally:
+                        # Close it instead of returning it listening to the pool
+                        connection.invalidate()
+            except Exception:
+                logger.exception('Lost the notifications of %s; reconnecting.', CHANNEL)
+            self._stop.wait(self.reconnect)
+
+    def listen(self, connection):
+        """Applies the notifications of a psycopg2 ``connection``
+        until :meth:`.stop`.
+        """
+        while not self._stop.is_set():
+            if select.select([connection], [], [], self.poll) == ([], [], []):
+                continue
+            connection.poll()
+            while connection.notifies:
+                self.apply(connection.notifies.pop(0).payload)
+
+    def apply(self, payload: str):
+        tags = self.app.resources['Tag']
+        id_ranges = parse(payload)
+        if id_ranges is None or \
+                sum(last - first + 1 for first, last in id_ranges) > tags.redirects.maxsize:
+            tags.redirects.clear()
+            if id_ranges is None:
+                tags.devicehubs.clear()
+        else:
+            tags.redirects.invalidate(*(_id for first, last in id_ranges
+                                        for _id in range(first, last + 1)))
+        if tags.lookup is not None:
+            tags.lookup.expire()
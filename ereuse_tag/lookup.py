@@ -0,0 +1,177 @@
+"""Rejection of scans of ids that cannot be in the tag table without
+querying the database, so storms of scans of garbage ids do not
+reach it.
+
+With ``TAG_LOOKUP_FILTER``, :class:`LookupFilter` keeps:
+
+- The last value of ``tag_id_seq``, as decoded ids greater than it
+  do not exist.
+- The secondary ids, in a :class:`BloomFilter`, as ids that are not
+  in it are not secondary ids.
+- A negative cache with the last ids that were not found.
+
+It is refreshed every ``TAG_LOOKUP_FILTER_REFRESH`` seconds, reading
+only the secondary ids changed since the previous refresh, and after
+tags change (see :mod:`ereuse_tag.invalidation`). Until then, tags
+created or given a secondary id by other processes can be rejected,
+as the redirect cache shows old locations until it expires.
+
+Tags loaded by ``import`` keep their old ``updated``, so the filter
+is rebuilt, reading all the secondary ids, when an ``import`` job
+advances, and every :attr:`LookupFilter.REBUILD` seconds in case
+tags are loaded otherwise.
+"""
+import hashlib
+import math
+import threading
+import time
+from typing import Iterator, List, Tuple
+
+from sqlalchemy import text
+
+from ereuse_tag import bulk, edge
+from ereuse_tag.cache import LRUCache
+from ereuse_tag.db import db
+
+
+class BloomFilter:
+    """A set of strings that only answers whether a string may be in
+    it or is not, taking about 1.2 bytes per string for 1% of false
+    positives.
+
+    :param capacity: The number of strings it can hold before it
+                     has more false positives than ``error``.
+    """
+
+    def __init__(self, capacity: int, error: float = 0.01) -> None:
+        self.capacity = max(capacity, 1)
+        self.size = max(64, int(-self.capacity * math.log(error) / math.log(2) ** 2))
+        """Number of bits."""
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        """Strings added, counting the repeated ones."""
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: str) -> Iterator[int]:
+        # Double hashing: the bits are a + i * b
+        digest = hashlib.sha1(value.encode()).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:16], 'little') | 1
+        return ((a + i * b) % self.size for i in range(self.hashes))
+
+    def add(self, value: str):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    @property
+    def full(self) -> bool:
+        return self.count > self.capacity
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+
+class LookupFilter:
+    """Tells which forms of a scanned id can exist. See the module.
+
+    It reads the database with ``db.session``, so use it in an app
+    context.
+
+    :param refresh: Seconds between refreshes.
+    :param negative_size: Ids kept in the negative cache.
+    :param negative_ttl: Seconds an id stays in the negative cache.
+    """
+    MIN_CAPACITY = 2 ** 16
+    """The minimum capacity of the filter of secondary ids, which is
+    rebuilt with twice the secondary ids when it is full."""
+    REBUILD = 3600
+    """Seconds before reading all the secondary ids again."""
+    BOUND_REFRESH = 1
+    """Seconds before reading ``tag_id_seq`` again for an id greater
+    than its last value."""
+    LAST_ID = text('SELECT last_value, CURRENT_TIMESTAMP FROM tag_id_seq')
+    LAST_IMPORT = text('SELECT max(updated) FROM job WHERE command = \'import\'')
+
+    def __init__(self, refresh: float, negative_size: int, negative_ttl: float,
+                 error: float = 0.01) -> None:
+        self.refresh_every = refresh
+        self.error = error
+        self.missing = LRUCache(negative_size, negative_ttl)
+        """The last ids that were not found."""
+        self.last_id = 0
+        self.secondaries = None  # type: BloomFilter
+        self._watermark = None
+        self._last_import = None
+        self._next_refresh = 0.0
+        self._next_rebuild = 0.0
+        self._bound_refreshed = 0.0
+        self._lock = threading.Lock()
+
+    def check(self, id: str, ids: List[int]) -> Tuple[List[int], bool]:
+        """Gets the ``ids`` that ``id`` decodes to that can exist, and
+        whether ``id`` can be a secondary id.
+        """
+        if self.missing.get(id):
+            return [], False
+        self.refresh()
+        if ids and max(ids) > self.last_id \
+                and time.monotonic() - self._bound_refreshed >= self.BOUND_REFRESH:
+            self._refresh_bound()
+        return [_id for _id in ids if _id <= self.last_id], id in self.secondaries
+
+    def not_found(self, id: str):
+        """Records that the tag ``id`` is not in the database."""
+        self.missing.set(id, True)
+
+    def expire(self):
+        """Refreshes at the next scan. Call it when this process
+        changes tags.
+        """
+        self._next_refresh = 0.0
+        self.missing.clear()
+
+    def refresh(self):
+        """Reads the changes of the tag table if it is time to.
+
+        Only the first refresh makes scans wait; the next ones are
+        done by one scan while the rest use the current state.
+        """
+        if time.monotonic() < self._next_refresh:
+            return
+        if not self._lock.acquire(blocking=self.secondaries is None):
+            return
+        try:
+            if time.monotonic() < self._next_refresh:
+                return  # Another thread just refreshed
+            self._next_refresh = time.monotonic() + self.refresh_every
+            watermark = self._refresh_bound()
+            last_import = db.session.execute(self.LAST_IMPORT).scalar()
+            if self.secondaries is None or self.secondaries.full \
+                    or last_import != self._last_import \
+                    or time.monotonic() >= self._next_rebuild:
+                self._next_rebuild = time.monotonic() + self.REBUILD
+                num = db.session.execute('SELECT count(*) FROM tag '
+                                         'WHERE secondary IS NOT NULL').scalar()
+                secondaries = BloomFilter(max(num * 2, self.MIN_CAPACITY), self.error)
+                since = None
+            else:
+                secondaries = self.secondaries
+                since = self._watermark - edge.SAFETY
+            for chunk in bulk.stream_secondary_ids(since=since):
+                for secondary in chunk:
+                    secondaries.add(secondary)
+            self.secondaries, self._watermark = secondaries, watermark
+            self._last_import = last_import
+            self.missing.clear()
+        except Exception:
+            self._next_refresh = 0.0
+            raise
+        finally:
+            self._lock.release()
+
+    def _refresh_bound(self):
+        self.last_id, now = db.session.execute(self.LAST_ID).first()
+        self._bound_refreshed = time.monotonic()
+        return now
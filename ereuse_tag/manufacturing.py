@@ -0,0 +1,180 @@
+"""Files to manufacture and print ETags, like the ones Tag IT Smart
+(TIS) manufacturers expect.
+
+An order is a directory with:
+
+- Shards, CSV files (optionally gzipped) with one ETag per row: its id
+  and the URL printed in its QR code and NFC chip.
+- ``SHA256SUMS``, the checksums of the shards, which you can check with
+  ``sha256sum -c SHA256SUMS``.
+- ``manifest.json``, describing the order and each shard.
+
+The ids of the tags are reserved in the database beforehand, and the
+shards are encoded and written in parallel by a pool of processes.
+"""
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple
+
+from hashids import Hashids
+
+from ereuse_tag.codec import Codec
+
+CHUNK = 10000
+"""Ids encoded at once by a worker."""
+MANIFEST = 'manifest.json'
+CHECKSUMS = 'SHA256SUMS'
+
+Range = Tuple[int, int]
+"""First and last database id, both inclusive."""
+
+
+def ranges(ids: Iterable[int]) -> Iterator[Range]:
+    """Compresses sorted ``ids`` into ranges of consecutive ids."""
+    first = last = None
+    for _id in ids:
+        if last is not None and _id == last + 1:
+            last = _id
+        else:
+            if first is not None:
+                yield first, last
+            first = last = _id
+    if first is not None:
+        yield first, last
+
+
+def shard(id_ranges: List[Range], num: int) -> List[List[Range]]:
+    """Splits ``id_ranges`` into ``num`` shards with about the same
+    number of ids each, keeping the order of the ids.
+    """
+    total = sum(last - first + 1 for first, last in id_ranges)
+    size = -(-total // num)  # Ceil
+    shards, current, left = [], [], size
+    for first, last in id_ranges:
+        while first <= last:
+            end = min(last, first + left - 1)
+            current.append((first, end))
+            left -= end - first + 1
+            first = end + 1
+            if not left:
+                shards.append(current)
+                current, left = [], size
+    if current:
+        shards.append(current)
+    return shards
+
+
+class _HashingWriter(io.RawIOBase):
+    """Writes to a file computing its SHA-256."""
+
+    def __init__(self, f) -> None:
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.sha256.update(b)
+        return self.f.write(b)
+
+
+_codec = None  # type: Codec
+_id_prefix = _url_prefix = None  # type: str
+
+
+def _init(salt: str, hash_min: int, hash_alphabet: str, id_prefix: str, url_prefix: str):
+    """Sets up a worker of the pool."""
+    global _codec, _id_prefix, _url_prefix
+    _codec = Codec(Hashids(salt=salt, min_length=hash_min, alphabet=hash_alphabet))
+    _id_prefix, _url_prefix = id_prefix, url_prefix
+
+
+def _write_shard(args: Tuple[Path, List[Range], bool]) -> dict:
+    path, id_ranges, compress = args
+    num = 0
+    with path.open('wb') as f:
+        hashing = _HashingWriter(f)
+        raw = gzip.GzipFile(fileobj=hashing, mode='wb', mtime=0) if compress \
+            else io.BufferedWriter(hashing, 2 ** 20)
+        with io.TextIOWrapper(raw, newline='') as text:
+            writer = csv.writer(text)
+            for first, last in id_ranges:
+                for start in range(first, last + 1, CHUNK):
+                    hashes = _codec.encode_many(range(start, min(start + CHUNK, last + 1)))
+                    writer.writerows((_id_prefix + hash, _url_prefix + hash) for hash in hashes)
+                    num += len(hashes)
+    return {
+        'file': path.name,
+        'tags': num,
+        'first': id_ranges[0][0],
+        'last': id_ranges[-1][1],
+        'sha256': hashing.sha256.hexdigest()
+    }
+
+
+def generate(directory: Path, id_ranges: List[Range], base_url: str, provider_id: str,
+             salt: str, hash_min: int, hash_alphabet: str, shards: int = 1,
+             workers: int = None, compress: bool = False, progress=None) -> dict:
+    """Writes the files of an order of ETags with the database ids
+    in ``id_ranges`` into ``directory``.
+
+    :param base_url: The URL of the tags, before their ids.
+    :param workers: Number of processes. By default, one per CPU.
+    :param progress: A function called with the number of tags of
+                     each shard once it is written.
+    :return: The manifest.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    suffix = '.csv.gz' if compress else '.csv'
+    tasks = [(directory / 'etags-{:04d}{}'.format(i, suffix), part, compress)
+             for i, part in enumerate(shard(id_ranges, shards))]
+    id_prefix = '{}-'.format(provider_id)
+    init_args = salt, hash_min, hash_alphabet, id_prefix, base_url + id_prefix
+    results = []
+    with multiprocessing.Pool(workers, _init, init_args) as pool:
+        for result in pool.imap_unordered(_write_shard, tasks):
+            results.append(result)
+            if progress:
+                progress(result['tags'])
+    results.sort(key=lambda r: r['file'])
+    manifest = {
+        'provider_id': provider_id,
+        'url': base_url,
+        'tags': sum(r['tags'] for r in results),
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'columns': ['id', 'url'],
+        'shards': results
+    }
+    with (directory / CHECKSUMS).open('w') as f:
+        f.writelines('{}  {}\n'.format(r['sha256'], r['file']) for r in results)
+    with (directory / MANIFEST).open('w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def verify(directory: Path) -> List[str]:
+    """Checks the shards of the order in ``directory`` against its
+    manifest, returning the problems found.
+    """
+    with (directory / MANIFEST).open() as f:
+        manifest = json.load(f)
+    problems = []
+    for part in manifest['shards']:
+        path = directory / part['file']
+        if not path.exists():
+            problems.append('{} is missing'.format(part['file']))
+            continue
+        sha256 = hashlib.sha256()
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(2 ** 20), b''):
+                sha256.update(chunk)
+        if sha256.hexdigest() != part['sha256']:
+            problems.append('{} has a wrong checksum'.format(part['file']))
+    return problems
@@ -0,0 +1,151 @@
+"""Minimal, in-process metrics rendered in the Prometheus text format.
+
+Metrics are kept per process; scrape every worker, or run one.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class Metric:
+    TYPE = None  # type: str
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _labels(self, values: tuple, **extra) -> str:
+        pairs = list(zip(self.labels, values)) + sorted(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+    def render(self) -> Iterator[str]:
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} {}'.format(self.name, self.TYPE)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values = {}  # type: Dict[tuple, float]
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield from super().render()
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield '{}{} {}'.format(self.name, self._labels(labels), value)
+
+
+class Gauge(Counter):
+    TYPE = 'gauge'
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    BUCKETS = .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self._values = {}  # type: Dict[tuple, Tuple[List[int], List[float]]]
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0]))
+            counts[i] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        yield from super().render()
+        with self._lock:
+            values = sorted((labels, (list(counts), total[0]))
+                            for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, self._labels(labels, le=bucket),
+                                              cumulative)
+            yield '{}_sum{} {}'.format(self.name, self._labels(labels), total)
+            yield '{}_count{} {}'.format(self.name, self._labels(labels), cumulative)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = []  # type: List[Metric]
+
+REQUEST_DURATION = Histogram('tag_request_duration_seconds',
+                             'Time to answer a request, per view method.',
+                             ('view',))
+RESOLUTIONS = Counter('tag_resolutions_total',
+                      'Scanned ids resolved, per form of id '
+                      '(tag, etag, secondary or cache).',
+                      ('form',))
+DECODE_FAILURES = Counter('tag_decode_failures_total',
+                          'Scanned ids that are neither a Tag nor an ETag id.')
+FILTERED_SCANS = Counter('tag_filtered_scans_total',
+                        'Scanned ids rejected by the lookup filter without querying.')
+NO_REMOTE_TAG = Counter('tag_no_remote_tag_total',
+                        'Scans of tags not assigned to a Devicehub.')
+DEVICEHUB_REQUESTS = Counter('tag_devicehub_requests_total',
+                             'Redirects and tag creations, per Devicehub.',
+                             ('devicehub', 'view'))
+DB_QUERY_DURATION = Histogram('tag_db_query_duration_seconds',
+                              'Time executing SQL statements.')
+REDIRECT_CACHE = Gauge('tag_redirect_cache',
+                       'Hits, misses and size of the redirect cache.',
+                       ('stat',))
+
+
+def render() -> str:
+    """Renders all the metrics in the Prometheus text format."""
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    DB_QUERY_DURATION.observe(time.perf_counter() - conn.info['query_start'].pop())
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    starts = context.connection.info.get('query_start') if context.connection else None
+    if starts:
+        starts.pop()
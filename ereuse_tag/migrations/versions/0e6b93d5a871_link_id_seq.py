@@ -0,0 +1,26 @@
+"""link id seq
+
+Revision ID: 0e6b93d5a871
+Revises: f4d81a6c2e35
+Create Date: 2026-10-18 23:31:40.582913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0e6b93d5a871'
+down_revision = 'f4d81a6c2e35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Databases created with the initial migration do not have it
+    op.execute('CREATE SEQUENCE IF NOT EXISTS link_id_seq OWNED BY link.id')
+    op.execute('SELECT setval(\'link_id_seq\', COALESCE(MAX(id), 0) + 1, false) FROM link')
+
+
+def downgrade():
+    pass
@@ -0,0 +1,47 @@
+"""devicehub table
+
+Revision ID: 5d2a8e6f1c47
+Revises: e1b7c05d94a2
+Create Date: 2026-10-18 20:41:37.216405
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import teal.db
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2a8e6f1c47'
+down_revision = 'e1b7c05d94a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('devicehub',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('url', teal.db.URL(), nullable=False),
+                    sa.Column('updated', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+                    sa.Column('created', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('url'))
+    op.add_column('tag', sa.Column('devicehub_id', sa.Integer(), nullable=True))
+    op.execute('INSERT INTO devicehub (url) '
+               'SELECT DISTINCT devicehub FROM tag WHERE devicehub IS NOT NULL')
+    op.execute('UPDATE tag SET devicehub_id = devicehub.id '
+               'FROM devicehub WHERE devicehub.url = tag.devicehub')
+    op.create_foreign_key('tag_devicehub_id_fkey', 'tag', 'devicehub', ['devicehub_id'], ['id'])
+    op.create_index(op.f('ix_tag_devicehub_id'), 'tag', ['devicehub_id'], unique=False)
+    op.drop_column('tag', 'devicehub')
+
+
+def downgrade():
+    op.add_column('tag', sa.Column('devicehub', teal.db.URL(), nullable=True,
+                                   comment='URL with the database'))
+    op.execute('UPDATE tag SET devicehub = devicehub.url '
+               'FROM devicehub WHERE devicehub.id = tag.devicehub_id')
+    op.drop_index(op.f('ix_tag_devicehub_id'), table_name='tag')
+    op.drop_column('tag', 'devicehub_id')
+    op.drop_table('devicehub')
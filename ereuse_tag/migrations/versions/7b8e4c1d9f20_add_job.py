@@ -0,0 +1,43 @@
+"""add job
+
+Revision ID: 7b8e4c1d9f20
+Revises: a3f09d2c6b18
+Create Date: 2026-10-18 22:08:45.127390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '7b8e4c1d9f20'
+down_revision = 'a3f09d2c6b18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('job',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('command', sa.Unicode(), nullable=False),
+                    sa.Column('arguments', sa.Unicode(), nullable=False,
+                              comment='The arguments as sorted JSON.'),
+                    sa.Column('checkpoint', postgresql.JSONB(), server_default='{}',
+                              nullable=False,
+                              comment='Where to resume; its contents depend on the command.'),
+                    sa.Column('done', sa.BigInteger(), server_default='0', nullable=False),
+                    sa.Column('total', sa.BigInteger(), nullable=True),
+                    sa.Column('finished', sa.TIMESTAMP(timezone=True), nullable=True),
+                    sa.Column('updated', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+                    sa.Column('created', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_job_unfinished', 'job', ['command'],
+                    postgresql_where=sa.text('finished IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_job_unfinished', table_name='job')
+    op.drop_table('job')
@@ -0,0 +1,43 @@
+"""bulk secondaries
+
+Revision ID: 8a1f5e2c7d64
+Revises: 0e6b93d5a871
+Create Date: 2026-10-19 00:12:06.219574
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a1f5e2c7d64'
+down_revision = '0e6b93d5a871'
+branch_labels = None
+depends_on = None
+
+FUNCTION = '''
+CREATE OR REPLACE FUNCTION tag_unique_secondary() RETURNS trigger AS $$
+BEGIN
+    IF NEW.secondary IS NOT NULL{bulk} THEN{shared}
+        PERFORM pg_advisory_xact_lock(hashtext('tag.secondary'), hashtext(NEW.secondary));
+        IF (SELECT count(*) FROM tag WHERE secondary = NEW.secondary) > 1 THEN
+            RAISE unique_violation USING CONSTRAINT = 'ix_tag_secondary',
+                MESSAGE = 'duplicate secondary id ' || NEW.secondary;
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+'''
+
+
+def upgrade():
+    op.execute(FUNCTION.format(
+        bulk='\n            AND current_setting(\'tag.bulk_secondaries\', true) '
+             'IS DISTINCT FROM \'on\'',
+        shared='\n        PERFORM pg_advisory_xact_lock_shared(hashtext(\'tag.secondary\'));'
+    ))
+
+
+def downgrade():
+    op.execute(FUNCTION.format(bulk='', shared=''))
@@ -0,0 +1,26 @@
+"""index tag secondary
+
+Revision ID: 9c4f1a2b7d3e
+Revises: 386b38db550e
+Create Date: 2026-10-18 10:12:40.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4f1a2b7d3e'
+down_revision = '386b38db550e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_tag_secondary', 'tag', ['secondary'],
+                    unique=True,
+                    postgresql_where=sa.text('secondary IS NOT NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_tag_secondary', table_name='tag')
@@ -0,0 +1,89 @@
+"""partition tag
+
+Revision ID: a3f09d2c6b18
+Revises: 5d2a8e6f1c47
+Create Date: 2026-10-18 21:26:53.804117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f09d2c6b18'
+down_revision = '5d2a8e6f1c47'
+branch_labels = None
+depends_on = None
+
+SIZE = 10 ** 7
+"""ereuse_tag.partitions.SIZE when this revision was written."""
+COLUMNS = 'id, secondary, type, frozen, updated, created, devicehub_id'
+TABLE = '''CREATE TABLE {name} (
+    id BIGINT NOT NULL CHECK (id BETWEEN 1 AND 1000000000000),
+    secondary VARCHAR,
+    type VARCHAR NOT NULL,
+    frozen BOOLEAN DEFAULT false NOT NULL,
+    updated TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    created TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    devicehub_id INTEGER,
+    CONSTRAINT tag_pkey PRIMARY KEY (id),
+    CONSTRAINT tag_devicehub_id_fkey FOREIGN KEY (devicehub_id) REFERENCES devicehub (id)
+) {options}'''
+FROZEN = 'The Devicehub is final and redirects can be cached longer.'
+
+
+def rename_old():
+    op.execute('ALTER TABLE tag RENAME TO tag_old')
+    op.execute('ALTER TABLE tag_old RENAME CONSTRAINT tag_pkey TO tag_old_pkey')
+    op.execute('ALTER TABLE tag_old '
+               'RENAME CONSTRAINT tag_devicehub_id_fkey TO tag_old_devicehub_id_fkey')
+    for index in 'ix_tag_type', 'ix_tag_secondary', 'ix_tag_devicehub_id':
+        op.execute('ALTER INDEX {0} RENAME TO {0}_old'.format(index))
+
+
+def copy_old():
+    op.execute('INSERT INTO tag ({0}) SELECT {0} FROM tag_old'.format(COLUMNS))
+    op.execute('DROP TABLE tag_old')
+    op.alter_column('tag', 'frozen', comment=FROZEN)
+    op.create_index(op.f('ix_tag_type'), 'tag', ['type'], unique=False)
+    op.create_index(op.f('ix_tag_devicehub_id'), 'tag', ['devicehub_id'], unique=False)
+
+
+def upgrade():
+    rename_old()
+    op.execute(TABLE.format(name='tag', options='PARTITION BY RANGE (id)'))
+    last = op.get_bind().execute('SELECT COALESCE(MAX(id), 0) FROM tag_old').scalar()
+    for n in range(last // SIZE + 2):
+        op.execute('CREATE TABLE tag_p{:05d} PARTITION OF tag FOR VALUES FROM ({}) TO ({})'
+                   .format(n, n * SIZE, (n + 1) * SIZE))
+    copy_old()
+    op.create_index('ix_tag_secondary', 'tag', ['secondary'],
+                    postgresql_where=sa.text('secondary IS NOT NULL'))
+    op.create_index('ix_tag_id_brin', 'tag', ['id'], postgresql_using='brin')
+    op.create_index('ix_tag_created_brin', 'tag', ['created'], postgresql_using='brin')
+    op.execute('''
+    CREATE OR REPLACE FUNCTION tag_unique_secondary() RETURNS trigger AS $$
+    BEGIN
+        IF NEW.secondary IS NOT NULL THEN
+            PERFORM pg_advisory_xact_lock(hashtext('tag.secondary'), hashtext(NEW.secondary));
+            IF (SELECT count(*) FROM tag WHERE secondary = NEW.secondary) > 1 THEN
+                RAISE unique_violation USING CONSTRAINT = 'ix_tag_secondary',
+                    MESSAGE = 'duplicate secondary id ' || NEW.secondary;
+            END IF;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    CREATE TRIGGER tag_unique_secondary AFTER INSERT OR UPDATE OF secondary ON tag
+        FOR EACH ROW EXECUTE PROCEDURE tag_unique_secondary();
+    ''')
+
+
+def downgrade():
+    rename_old()
+    op.execute(TABLE.format(name='tag', options=''))
+    copy_old()
+    op.create_index('ix_tag_secondary', 'tag', ['secondary'],
+                    unique=True,
+                    postgresql_where=sa.text('secondary IS NOT NULL'))
+    op.execute('DROP FUNCTION tag_unique_secondary()')
@@ -0,0 +1,24 @@
+"""index tag updated
+
+Revision ID: c52d7e0a3b94
+Revises: 7b8e4c1d9f20
+Create Date: 2026-10-18 22:47:19.660281
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c52d7e0a3b94'
+down_revision = '7b8e4c1d9f20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_tag_updated'), 'tag', ['updated'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_tag_updated'), table_name='tag')
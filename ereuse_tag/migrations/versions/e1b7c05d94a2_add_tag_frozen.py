@@ -0,0 +1,27 @@
+"""add tag frozen
+
+Revision ID: e1b7c05d94a2
+Revises: 9c4f1a2b7d3e
+Create Date: 2026-10-18 13:02:11.540917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1b7c05d94a2'
+down_revision = '9c4f1a2b7d3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('tag', sa.Column('frozen', sa.Boolean(), server_default=sa.false(),
+                                   nullable=False,
+                                   comment='The Devicehub is final and redirects can be '
+                                           'cached longer.'))
+
+
+def downgrade():
+    op.drop_column('tag', 'frozen')
@@ -0,0 +1,43 @@
+"""add outbox
+
+Revision ID: f4d81a6c2e35
+Revises: c52d7e0a3b94
+Create Date: 2026-10-18 23:02:17.436128
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4d81a6c2e35'
+down_revision = 'c52d7e0a3b94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox',
+                    sa.Column('id', sa.BigInteger(), nullable=False),
+                    sa.Column('devicehub_id', sa.Integer(), nullable=False),
+                    sa.Column('start', sa.BigInteger(), nullable=False),
+                    sa.Column('end', sa.BigInteger(), nullable=False),
+                    sa.Column('done', sa.BigInteger(), nullable=False,
+                              comment='The last id sent.'),
+                    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+                    sa.Column('next_attempt', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+                    sa.Column('error', sa.Unicode(), nullable=True,
+                              comment='Why the last attempt failed.'),
+                    sa.Column('delivered', sa.TIMESTAMP(timezone=True), nullable=True),
+                    sa.Column('created', sa.TIMESTAMP(timezone=True),
+                              server_default=sa.text('CURRENT_TIMESTAMP'), nullable=False),
+                    sa.ForeignKeyConstraint(['devicehub_id'], ['devicehub.id'], ),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_outbox_pending', 'outbox', ['devicehub_id', 'next_attempt'],
+                    postgresql_where=sa.text('delivered IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_outbox_pending', table_name='outbox')
+    op.drop_table('outbox')
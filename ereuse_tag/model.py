@@ -1,15 +1,98 @@
+import datetime
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
 import teal.db
 from boltons.urlutils import URL
-from flask import current_app, current_app as app
-from sqlalchemy import Column, Sequence
+from flask import current_app, current_app as app, has_app_context
+from sqlalchemy import Column, Sequence, event, or_
+from sqlalchemy.dialects.postgresql import JSONB, insert
 from sqlalchemy.ext.declarative import declared_attr
-from teal.db import URL as URLType, check_range
+from sqlalchemy.orm import Session, object_session
+from teal.db import ResourceNotFound, URL as URLType, check_range
 from teal.resource import url_for_resource
 from werkzeug.exceptions import BadRequest, UnprocessableEntity
 
+from ereuse_tag import invalidation, partitions
 from ereuse_tag.db import db
 
 
+class Devicehub(db.Model):
+    """A Devicehub where tags are sent to.
+
+    Tags reference their Devicehub, so moving a Devicehub to another
+    URL is updating one row.
+    """
+    id = Column(db.Integer, primary_key=True)
+    url = Column(URLType, nullable=False, unique=True)
+    updated = db.Column(db.TIMESTAMP(timezone=True),
+                        server_default=db.text('CURRENT_TIMESTAMP'),
+                        onupdate=db.func.now(),
+                        nullable=False)
+    created = db.Column(db.TIMESTAMP(timezone=True),
+                        server_default=db.text('CURRENT_TIMESTAMP'),
+                        nullable=False)
+
+    @property
+    def template(self) -> str:
+        """The location where the tags of this Devicehub redirect to,
+        as a format string expecting the id of the tag.
+        """
+        url = self.url.to_text().replace('{', '{{').replace('}', '}}')
+        return url + '/tags/{}/device'
+
+    @classmethod
+    def template_of(cls, id: int) -> Tuple[str, str, datetime.datetime]:
+        """The URL, :attr:`.template` and last update of the Devicehub
+        with ``id``, cached in the process.
+        """
+        return cls.templates_of((id,))[id]
+
+    @classmethod
+    def templates_of(cls, ids: Iterable[int]) \
+            -> Dict[int, Tuple[str, str, datetime.datetime]]:
+        """Like :meth:`.template_of` for many Devicehubs, getting the
+        ones not cached in one query.
+        """
+        cache = current_app.resources['Tag'].devicehubs
+        values, missing = {}, []
+        for id in set(ids):
+            value = cache.get(id)
+            if value is None:
+                missing.append(id)
+            else:
+                values[id] = value
+        if missing:
+            for devicehub in cls.query.filter(cls.id.in_(missing)):
+                values[devicehub.id] = (devicehub.url.to_text(), devicehub.template,
+                                        devicehub.updated)
+                cache.set(devicehub.id, values[devicehub.id])
+        return values
+
+    @classmethod
+    def id_of(cls, url) -> int:
+        """The id of the Devicehub at ``url``, adding the Devicehub if
+        it is new.
+
+        The ids of existing Devicehubs are cached in the process.
+        """
+        url = URL(url)
+        cache = current_app.resources['Tag'].devicehubs
+        key = url.to_text()
+        id = cache.get(key)
+        if id is None:
+            id = db.session.query(cls.id).filter_by(url=url).scalar()
+            if id is None:
+                db.session.execute(insert(cls.__table__).values(url=url).on_conflict_do_nothing())
+                id = db.session.query(cls.id).filter_by(url=url).scalar()
+            else:  # Do not cache ids that are not committed yet
+                cache.set(key, id)
+        return id
+
+    def __repr__(self) -> str:
+        return '<Devicehub {0.id} {0.url}>'.format(self)
+
+
 class Tag(db.Model):
     _id = Column('id',
                  db.BigInteger,
@@ -17,19 +100,48 @@ class Tag(db.Model):
                  check_range('id', 1, 10 ** 12),  # Imposed by QR size
                  primary_key=True)
     secondary = Column(db.Unicode)
-    devicehub = Column(URLType, comment='URL with the database')
+    devicehub_id = Column(db.Integer, db.ForeignKey(Devicehub.id), index=True)
+    _devicehub = db.relationship(Devicehub)
     type = Column(db.Unicode(), nullable=False, index=True)
+    frozen = Column(db.Boolean,
+                    nullable=False,
+                    server_default=db.false(),
+                    comment='The Devicehub is final and redirects can be cached longer.')
     updated = db.Column(db.TIMESTAMP(timezone=True),
                         server_default=db.text('CURRENT_TIMESTAMP'),
-                        nullable=False)
+                        onupdate=db.func.now(),
+                        nullable=False,
+                        index=True)
+    """When the tag changed. Statements that change tags without the
+    ORM have to set it too.
+    """
     created = db.Column(db.TIMESTAMP(timezone=True),
                         server_default=db.text('CURRENT_TIMESTAMP'),
                         nullable=False)
+    __table_args__ = (
+        # Unique through partitions.UNIQUE_SECONDARY
+        db.Index('ix_tag_secondary', secondary, postgresql_where=secondary.isnot(None)),
+        db.Index('ix_tag_id_brin', _id, postgresql_using='brin'),
+        db.Index('ix_tag_created_brin', created, postgresql_using='brin'),
+        {'postgresql_partition_by': 'RANGE (id)'}
+    )
+    """The table is partitioned by ranges of ids; see
+    :mod:`ereuse_tag.partitions`.
+    """
 
     @property
     def url(self):
         return url_for_resource(self, self.id)
 
+    @property
+    def devicehub(self) -> Optional[URL]:
+        """The URL of the Devicehub of the tag, with the database."""
+        return self._devicehub.url if self._devicehub else None
+
+    @devicehub.setter
+    def devicehub(self, url: URL):
+        self._devicehub = Devicehub.query.get(Devicehub.id_of(url)) if url else None
+
     @property
     def remote_tag(self) -> URL:
         """The URL of the linked tag.
@@ -50,6 +162,17 @@ class Tag(db.Model):
         tag_url.path_parts += 'device',
         return tag_url
 
+    @property
+    def location(self) -> str:
+        """:attr:`.remote_device` as text, made from the cached
+        template of the Devicehub instead of parsing its URL.
+
+        :raise NoRemoteTag: The tag has not been set to a Devicehub.
+        """
+        if self.devicehub_id is None:
+            raise NoRemoteTag()
+        return Devicehub.template_of(self.devicehub_id)[1].format(self.id)
+
     @declared_attr
     def __mapper_args__(cls):
         """
@@ -66,7 +189,7 @@ class Tag(db.Model):
 
     @property
     def id(self):
-        return app.resources['Tag'].hashids.encode(self._id)
+        return app.resources['Tag'].codec.encode(self._id)
 
     @id.setter
     def id(self, id):
@@ -74,10 +197,92 @@ class Tag(db.Model):
 
     @classmethod
     def decode(cls, id):
-        res = current_app.resources['Tag'].hashids.decode(id)
-        if not res:
-            raise ValueError('{} is not a valid Tag.'.format(id))
-        return res[0]
+        return current_app.resources['Tag'].codec.decode(id)
+
+    @classmethod
+    def candidates(cls, id: str) -> List[int]:
+        """The database ids that ``id`` decodes to, either as an
+        ETag id or as a Tag id.
+        """
+        ids = []
+        for T in ETag, Tag:
+            try:
+                ids.append(T.decode(id))
+            except ValueError:
+                pass
+        return ids
+
+    @classmethod
+    def database_id(cls, id: str) -> Optional[int]:
+        """The database id of the ETag or Tag id ``id``, or ``None``
+        if ``id`` is not one of them or belongs to another provider.
+        """
+        try:
+            ids = cls.candidates(id)
+        except UnprocessableEntity:
+            return None
+        return ids[0] if ids else None
+
+    @classmethod
+    def find(cls, id: str, ids: List[int] = None, session: Session = None,
+             secondary: bool = True) -> Optional['Tag']:
+        """Gets the tag identified by ``id`` in one indexed query,
+        be ``id`` an ETag id, a Tag id or a secondary id, or ``None``.
+
+        Tags matching the decoded id are preferred over tags
+        matching the secondary id.
+
+        :param ids: The :meth:`.candidates` of ``id``, if you
+                    already have them.
+        :param session: The session to query, if not ``db.session``.
+        :param secondary: Whether ``id`` can be a secondary id.
+        """
+        if ids is None:
+            ids = cls.candidates(id)
+        conditions = [Tag.secondary == id] if secondary else []
+        if ids:
+            conditions.append(Tag._id.in_(ids))
+        if not conditions:
+            return None
+        query = session.query(Tag) if session is not None else Tag.query
+        query = query.filter(or_(*conditions))
+        if ids:  # Tags matching the decoded id first
+            query = query.order_by(Tag._id.in_(ids).desc())
+        return query.first()
+
+    @classmethod
+    def find_many(cls, ids: Dict[str, List[int]], session: Session = None) -> Dict[str, 'Tag']:
+        """Like :meth:`.find` for many ids at once, in one query.
+
+        :param ids: The ids to find, with their :meth:`.candidates`.
+        :return: The found tags by the id they were found with.
+        """
+        _ids = {_id for candidates in ids.values() for _id in candidates}
+        conditions = [Tag.secondary.in_(list(ids))]
+        if _ids:
+            conditions.append(Tag._id.in_(_ids))
+        query = session.query(Tag) if session is not None else Tag.query
+        tags = query.filter(or_(*conditions)).all()
+        by_id = {tag._id: tag for tag in tags}
+        by_secondary = {tag.secondary: tag for tag in tags if tag.secondary is not None}
+        found = {}
+        for id, candidates in ids.items():
+            tag = next((by_id[_id] for _id in candidates if _id in by_id), None) \
+                  or by_secondary.get(id)
+            if tag is not None:
+                found[id] = tag
+        return found
+
+    @classmethod
+    def resolve(cls, id: str, ids: List[int] = None, secondary: bool = True) -> 'Tag':
+        """Like :meth:`.find` but raising if there is no tag.
+
+        :raise ResourceNotFound: No tag is identified by ``id``.
+        """
+        tag = cls.find(id, ids, secondary=secondary)
+        if tag is None:
+            raise ResourceNotFound(Tag.t)
+        return tag
 
     def __repr__(self) -> str:
         return '<Tag {0.id} device={0.device_id}>'.format(self)
@@ -98,25 +303,208 @@ class ETag(Tag):
 
     @classmethod
     def decode(cls, id):
+        return super().decode(cls.hash(id))
+
+    @staticmethod
+    def hash(id: str) -> str:
+        """Gets the hashid of ``id``, the part after the provider ID.
+
+        :raise UnprocessableEntity: The tag belongs to another provider.
+        """
         try:
             provider_id, hash = id.split('-')
         except ValueError:
             raise ValueError('Not an ETag.')
-        if provider_id != app.config['TAG_PROVIDER_ID'].lower():
+        if provider_id.lower() != app.config['TAG_PROVIDER_ID'].lower():
             raise UnprocessableEntity('The tag does not belong to this provider ID')
-        return super().decode(hash)
+        return hash
+
+
+@event.listens_for(Tag.__table__, 'after_create')
+def _create_partitions(table, connection, **kw):
+    partitions.create(connection)
+
+
+@event.listens_for(Tag._devicehub, 'set', propagate=True)
+@event.listens_for(Tag.devicehub_id, 'set', propagate=True)
+@event.listens_for(Tag.secondary, 'set', propagate=True)
+def _redirect_changed(tag: Tag, value, oldvalue, initiator):
+    """Invalidates the cached redirect of a tag that changes its
+    devicehub or secondary id, now and once the change is committed.
+    """
+    if tag._id is not None and has_app_context():
+        current_app.resources['Tag'].redirects.invalidate(tag._id)
+        session = object_session(tag)
+        if session is not None:
+            invalidation.invalidate(session, (tag._id,))
+
+
+@event.listens_for(Devicehub.url, 'set')
+def _devicehub_moved(devicehub: Devicehub, value, oldvalue, initiator):
+    """Forgets the cached templates and redirects once a Devicehub
+    that changes its URL is committed.
+    """
+    session = object_session(devicehub)
+    if devicehub.id is not None and session is not None:
+        invalidation.clear(session)
+
+
+@event.listens_for(Session, 'after_flush')
+def _tags_created(session: Session, flush_context):
+    """Marks the session to refresh the lookup filter once the new
+    tags are committed.
+    """
+    if any(isinstance(instance, Tag) for instance in session.new):
+        session.info['new_tags'] = True
+
+
+@event.listens_for(Session, 'before_commit')
+def _notify_redirects(session: Session):
+    """Tells the rest of processes the redirects to invalidate."""
+    if has_app_context():
+        invalidation.notify(session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_redirects(session: Session):
+    ids, moved = invalidation.pending(session, pop=True)
+    created = session.info.pop('new_tags', False)
+    if has_app_context():
+        tags = current_app.resources['Tag']
+        if tags.lookup is not None and (ids or moved or created):
+            tags.lookup.expire()
+        if moved:
+            tags.devicehubs.clear()
+            tags.redirects.clear()
+        elif ids:
+            tags.redirects.invalidate(*ids)
 
 
 class NoRemoteTag(BadRequest):
     description = 'This tag has not been assigned to a Devicehub.'
 
 
+class Job(db.Model):
+    """A long-running CLI command that works in committed chunks,
+    with the point where it stopped so it can be resumed.
+    """
+    id = Column(db.Integer, primary_key=True)
+    command = Column(db.Unicode, nullable=False)
+    arguments = Column(db.Unicode, nullable=False, comment='The arguments as sorted JSON.')
+    checkpoint = Column(JSONB,
+                        nullable=False,
+                        server_default='{}',
+                        comment='Where to resume; its contents depend on the command.')
+    done = Column(db.BigInteger, nullable=False, server_default='0')
+    total = Column(db.BigInteger)
+    finished = Column(db.TIMESTAMP(timezone=True))
+    updated = db.Column(db.TIMESTAMP(timezone=True),
+                        server_default=db.text('CURRENT_TIMESTAMP'),
+                        nullable=False)
+    created = db.Column(db.TIMESTAMP(timezone=True),
+                        server_default=db.text('CURRENT_TIMESTAMP'),
+                        nullable=False)
+    __table_args__ = (
+        db.Index('ix_job_unfinished', command, postgresql_where=finished.is_(None)),
+    )
+
+    @classmethod
+    def start(cls, command: str, arguments: dict, total: int = None,
+              resume: bool = False) -> 'Job':
+        """Starts a new job, committing it, or gets the last unfinished
+        job of ``command`` with the same ``arguments`` to resume it.
+
+        :raise UnprocessableEntity: There is no job to resume.
+        """
+        arguments = json.dumps(arguments, sort_keys=True)
+        if resume:
+            job = cls.query.filter_by(command=command, arguments=arguments, finished=None) \
+                .order_by(cls.created.desc()).first()
+            if job is None:
+                raise UnprocessableEntity('There is no unfinished {} to resume with these '
+                                          'arguments.'.format(command))
+        else:
+            job = cls(command=command, arguments=arguments, checkpoint={}, done=0, total=total)
+            db.session.add(job)
+            db.session.commit()
+        return job
+
+    @classmethod
+    def last(cls, command: str, arguments: dict) -> Optional['Job']:
+        """The last finished job of ``command`` with ``arguments``."""
+        arguments = json.dumps(arguments, sort_keys=True)
+        return cls.query.filter_by(command=command, arguments=arguments) \
+            .filter(cls.finished.isnot(None)) \
+            .order_by(cls.finished.desc()).first()
+
+    def advance(self, done: int, **checkpoint):
+        """Records that ``done`` more items are done and where to
+        resume. Commit it with the work it records.
+        """
+        self.done += done
+        self.checkpoint = dict(self.checkpoint, **checkpoint)
+        self.updated = db.func.now()
+
+    def finish(self):
+        self.finished = self.updated = db.func.now()
+        db.session.commit()
+
+    def __repr__(self) -> str:
+        return '<Job {0.id} {0.command} {0.done}/{0.total}>'.format(self)
+
+
+class Outbox(db.Model):
+    """A range of tags set to a Devicehub, queued to send them to it.
+    See :mod:`ereuse_tag.delivery`.
+    """
+    id = Column(db.BigInteger, primary_key=True)
+    devicehub_id = Column(db.Integer, db.ForeignKey(Devicehub.id), nullable=False)
+    devicehub = db.relationship(Devicehub)
+    start = Column(db.BigInteger, nullable=False)
+    end = Column(db.BigInteger, nullable=False)
+    done = Column(db.BigInteger, nullable=False, comment='The last id sent.')
+    attempts = Column(db.Integer, nullable=False, server_default='0')
+    next_attempt = Column(db.TIMESTAMP(timezone=True),
+                          server_default=db.text('CURRENT_TIMESTAMP'),
+                          nullable=False)
+    error = Column(db.Unicode, comment='Why the last attempt failed.')
+    delivered = Column(db.TIMESTAMP(timezone=True))
+    created = db.Column(db.TIMESTAMP(timezone=True),
+                        server_default=db.text('CURRENT_TIMESTAMP'),
+                        nullable=False)
+    __table_args__ = (
+        db.Index('ix_outbox_pending', devicehub_id, next_attempt,
+                 postgresql_where=delivered.is_(None)),
+    )
+
+    @classmethod
+    def add(cls, devicehub_id: int, start: int, end: int):
+        """Queues the tags with ids between ``start`` and ``end``,
+        both inclusive, that are set to the Devicehub ``devicehub_id``
+        when they are sent. Commit it with the tags.
+        """
+        db.session.add(cls(devicehub_id=devicehub_id, start=start, end=end, done=start - 1,
+                           attempts=0))
+
+    def fail(self, error: str, backoff: int, max_backoff: int):
+        """Records a failed attempt, delaying the next one."""
+        self.attempts += 1
+        self.error = error
+        delay = min(backoff * 2 ** (self.attempts - 1), max_backoff)
+        self.next_attempt = db.func.now() + datetime.timedelta(seconds=delay)
+
+    def __repr__(self) -> str:
+        return '<Outbox {0.id} {0.devicehub_id} {0.start}-{0.end}>'.format(self)
+
+
 class Link(db.Model):
     """A Link to an URL.
 
-    Stores URLs and provides a hashed ID back.
+    Stores URLs and provides a hashed ID back, encoded as the ids
+    of the tags. Links do not change, so their redirects are cached
+    as long as possible. Create many at once with
+    :func:`ereuse_tag.bulk.insert_links`.
     """
-    # todo develop
     id = Column(db.BigInteger, Sequence('link_id_seq'), primary_key=True)
     url = Column(URLType, nullable=False, unique=True)
     updated = db.Column(db.TIMESTAMP(timezone=True),
@@ -125,3 +513,23 @@ class Link(db.Model):
     created = db.Column(db.TIMESTAMP(timezone=True),
                         server_default=db.text('CURRENT_TIMESTAMP'),
                         nullable=False)
+
+    @property
+    def code(self) -> str:
+        """The hashed id of the link."""
+        return app.resources['Tag'].codec.encode(self.id)
+
+    @classmethod
+    def url_of(cls, code: str) -> Optional[str]:
+        """The URL of the link with the hashed id ``code``, as text,
+        or ``None``.
+        """
+        try:
+            _id = current_app.resources['Tag'].codec.decode(code)
+        except ValueError:
+            return None
+        url = db.session.query(cls.url).filter_by(id=_id).scalar()
+        return url.to_text() if url is not None else None
+
+    def __repr__(self) -> str:
+        return '<Link {0.id} {0.url}>'.format(self)
@@ -0,0 +1,129 @@
+"""Range partitions of the tag table.
+
+The tag table is partitioned by id in ranges of :data:`SIZE` ids, so
+range operations and maintenance only touch the partitions they need,
+and old partitions, whose tags are all set to a Devicehub, can be
+detached and archived.
+
+Partitions are created ahead of the ids: before inserting tags, call
+:func:`ensure`. There is no default partition, so an insert whose
+partition does not exist fails instead of landing in the wrong place.
+
+As PostgreSQL cannot enforce a unique index on ``secondary`` across
+partitions, the :data:`UNIQUE_SECONDARY` trigger does it.
+"""
+from typing import List, Tuple
+
+from sqlalchemy import DDL, text
+from sqlalchemy.engine import Connection
+
+SIZE = 10 ** 7
+"""Number of ids of each partition. Changing it requires
+recreating the table."""
+LOCK = 0x7461675f70
+"""Advisory lock taken while creating partitions."""
+
+UNIQUE_SECONDARY = DDL('''
+CREATE OR REPLACE FUNCTION tag_unique_secondary() RETURNS trigger AS $$
+BEGIN
+    IF NEW.secondary IS NOT NULL
+            AND current_setting('tag.bulk_secondaries', true) IS DISTINCT FROM 'on' THEN
+        PERFORM pg_advisory_xact_lock_shared(hashtext('tag.secondary'));
+        PERFORM pg_advisory_xact_lock(hashtext('tag.secondary'), hashtext(NEW.secondary));
+        IF (SELECT count(*) FROM tag WHERE secondary = NEW.secondary) > 1 THEN
+            RAISE unique_violation USING CONSTRAINT = 'ix_tag_secondary',
+                MESSAGE = 'duplicate secondary id ' || NEW.secondary;
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER tag_unique_secondary AFTER INSERT OR UPDATE OF secondary ON tag
+    FOR EACH ROW EXECUTE PROCEDURE tag_unique_secondary();
+''')
+"""Keeps secondary ids unique. The advisory lock serializes the
+transactions setting the same secondary id, so the second one
+sees the first one's row once it commits.
+
+Transactions setting many secondary ids at once take instead
+:data:`LOCK_SECONDARIES` and check them by themselves, see
+:func:`ereuse_tag.bulk.set_secondaries`, as one lock per row would
+exhaust the lock table.
+"""
+LOCK_SECONDARIES = text("SELECT pg_advisory_xact_lock(hashtext('tag.secondary'))")
+"""Excludes the transactions setting secondary ids through the
+trigger of :data:`UNIQUE_SECONDARY`."""
+SKIP_UNIQUE_SECONDARY = text("SET LOCAL tag.bulk_secondaries = 'on'")
+"""Skips the trigger of :data:`UNIQUE_SECONDARY` until the end of
+the transaction. Take :data:`LOCK_SECONDARIES` before."""
+
+_ensured = -1
+"""The last partition this process knows to exist."""
+
+
+def name(n: int) -> str:
+    return 'tag_p{:05d}'.format(n)
+
+
+def number(_id: int) -> int:
+    """The number of the partition of the tag with ``_id``."""
+    return _id // SIZE
+
+
+def create(connection: Connection):
+    """Sets up a new tag table: its trigger and first partitions."""
+    global _ensured
+    _ensured = -1
+    connection.execute(UNIQUE_SECONDARY)
+    ensure(connection, 0)
+
+
+def ensure(connection: Connection, last_id: int, first_id: int = None):
+    """Creates the partitions of the ids up to ``last_id``, plus the
+    next one, so inserts with ids close to ``last_id`` do not wait
+    for it.
+
+    :param first_id: Create also the missing partitions from this id.
+                     By default only partitions after the last one
+                     are created, so detached partitions are not
+                     created again.
+    """
+    global _ensured
+    last = number(last_id) + 1
+    if last <= _ensured and first_id is None:
+        return
+    connection.execute(text('SELECT pg_advisory_xact_lock(:lock)'), lock=LOCK)
+    existing = {n for n, _ in partitions(connection)}
+    first = number(first_id) if first_id is not None else max(existing, default=-1) + 1
+    for n in range(first, last + 1):
+        if n not in existing:
+            connection.execute('CREATE TABLE {} PARTITION OF tag FOR VALUES FROM ({}) TO ({})'
+                               .format(name(n), n * SIZE, (n + 1) * SIZE))
+    _ensured = max(_ensured, last)
+
+
+def partitions(connection: Connection) -> List[Tuple[int, str]]:
+    """The numbers and names of the partitions, ordered."""
+    rows = connection.execute('SELECT c.relname FROM pg_inherits i '
+                              'JOIN pg_class c ON c.oid = i.inhrelid '
+                              'WHERE i.inhparent = \'tag\'::regclass')
+    return sorted((int(relname[len('tag_p'):]), relname) for relname, in rows)
+
+
+def stats(connection: Connection) -> List[Tuple[str, int, int, int, int]]:
+    """The name, first and last id, number of tags and number of
+    tags without Devicehub of each partition.
+    """
+    result = []
+    for n, relname in partitions(connection):
+        total, unset = connection.execute('SELECT count(*), count(*) - count(devicehub_id) '
+                                          'FROM {}'.format(relname)).first()
+        result.append((relname, n * SIZE, (n + 1) * SIZE - 1, total, unset))
+    return result
+
+
+def detach(connection: Connection, n: int):
+    """Detaches the partition ``n`` from the tag table, keeping it
+    as a normal table to archive. Its tags stop redirecting.
+    """
+    connection.execute('ALTER TABLE tag DETACH PARTITION {}'.format(name(n)))
@@ -0,0 +1,93 @@
+"""Opt-in profiling of the SQL statements of each request or CLI
+command.
+
+Set ``TAG_PROFILE_SQL`` to count the statements and their time,
+returned in a ``Server-Timing`` header, and to log the statements
+slower than ``TAG_SLOW_QUERY_MS`` with the view or command that
+executed them.
+"""
+import logging
+import time
+
+import click
+from flask import Flask, Response, current_app, g, has_app_context, has_request_context, \
+    request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+class Profile:
+    """The statements executed in an app context."""
+
+    def __init__(self) -> None:
+        self.queries = 0
+        self.duration = 0.0
+        """Milliseconds executing statements."""
+
+    @property
+    def server_timing(self) -> str:
+        return 'db;dur={:.1f};desc="{} queries"'.format(self.duration, self.queries)
+
+
+def init_app(app: Flask):
+    """Adds the ``Server-Timing`` header to the responses of ``app``,
+    and logs the totals of CLI commands, if ``TAG_PROFILE_SQL``
+    is set.
+    """
+    if app.config['TAG_PROFILE_SQL']:
+        app.after_request(_add_server_timing)
+        app.teardown_appcontext(_log_command)
+
+
+def caller() -> str:
+    """The view or CLI command being executed."""
+    if has_request_context():
+        return '{} {}'.format(request.method, request.endpoint)
+    ctx = click.get_current_context(silent=True)
+    return ctx.command_path if ctx else '?'
+
+
+def _add_server_timing(response: Response) -> Response:
+    profile = g.get('sql_profile')
+    if profile:
+        response.headers.add('Server-Timing', profile.server_timing)
+    return response
+
+
+def _log_command(exception=None):
+    profile = g.get('sql_profile')
+    if profile and not has_request_context():
+        logger.info('%s executed %d queries in %.1f ms', caller(), profile.queries,
+                    profile.duration)
+
+
+def _profiling() -> bool:
+    return has_app_context() and current_app.config.get('TAG_PROFILE_SQL', False)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _profiling():
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('profile_start')
+    if not starts or not _profiling():
+        return
+    duration = (time.perf_counter() - starts.pop()) * 1000
+    profile = g.setdefault('sql_profile', Profile())  # type: Profile
+    profile.queries += 1
+    profile.duration += duration
+    if duration >= current_app.config['TAG_SLOW_QUERY_MS']:
+        logger.warning('Slow query (%.1f ms) in %s: %s', duration, caller(), statement)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    starts = context.connection.info.get('profile_start') if context.connection else None
+    if starts:
+        starts.pop()
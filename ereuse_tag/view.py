@@ -1,53 +1,274 @@
+import hashlib
 import json
+from collections import namedtuple
+from typing import Dict, Iterator, List
 
-from flask import g, redirect, request
-from flask.json import jsonify
+from boltons.iterutils import chunked_iter
+from flask import Response, current_app, g, redirect, request
 from teal.resource import View
-from werkzeug.exceptions import NotFound, UnprocessableEntity
+from teal.db import ResourceNotFound
+from werkzeug.exceptions import HTTPException, NotFound, UnprocessableEntity
 
 from ereuse_tag import __version__
-from ereuse_tag import auth
+from ereuse_tag import auth, bulk, delivery, invalidation, manufacturing, metrics
+from ereuse_tag.cache import LRUCache, RedirectCache
 from ereuse_tag.db import db
-from ereuse_tag.model import ETag, Tag
+from ereuse_tag.lookup import LookupFilter
+from ereuse_tag.model import Devicehub, Link, NoRemoteTag, Tag
+
+
+class Redirect(namedtuple('Redirect', 'location devicehub updated frozen')):
+    """The resolved redirect of a tag, as kept in the cache."""
+    __slots__ = ()
+
+    @property
+    def etag(self) -> str:
+        value = '{}{}'.format(self.location, self.updated.isoformat())
+        return hashlib.sha1(value.encode()).hexdigest()[:20]
 
 
 class TagView(View):
+    JSON = 'application/json'
+    NDJSON = 'application/x-ndjson'
+
+    @metrics.REQUEST_DURATION.time('TagView.one')
     def one(self, id):
         """
         Redirects to the linked device or returns a HTTP 400 if
         no device has been linked yet.
         :param id: ID of the Tag.
         """
-        try:
-            _id = ETag.decode(id)
-        except ValueError:  # not an etag
+        redirects = self.resource_def.redirects  # type: RedirectCache
+        cached = redirects.get(id)
+        if cached is None:
+            ids = Tag.candidates(id)
+            if not ids:
+                metrics.DECODE_FAILURES.inc()
+            lookup = self.resource_def.lookup  # type: LookupFilter
+            secondary = True
+            if lookup is not None:
+                ids, secondary = lookup.check(id, ids)
+                if not ids and not secondary:
+                    metrics.FILTERED_SCANS.inc()
+                    raise ResourceNotFound(Tag.t)
+            tag = None
+            with self.resource_def.replicas.session() as session:
+                if session is not None:
+                    tag = Tag.find(id, ids, session, secondary)
+            if tag is None:  # No replicas or the replica does not have it yet
+                try:
+                    tag = Tag.resolve(id, ids, secondary)
+                except ResourceNotFound:
+                    if lookup is not None:
+                        lookup.not_found(id)
+                    raise
             try:
-                _id = Tag.decode(id)
-            except ValueError:  # not the id of a tag
-                # Is the secondary ID?
-                tag = Tag.query.filter_by(secondary=id).one()
-            else:
-                tag = Tag.query.filter_by(_id=_id).one()  # type: Tag
+                location = tag.location
+            except NoRemoteTag:
+                metrics.NO_REMOTE_TAG.inc()
+                raise
+            devicehub, _, moved = Devicehub.template_of(tag.devicehub_id)
+            # Moving the Devicehub changes the location of all its tags
+            cached = Redirect(location, devicehub, max(tag.updated, moved), tag.frozen)
+            form = 'secondary' if tag.secondary == id else tag.type.lower()
+            redirects.set(id, cached, tag._id)
         else:
-            tag = Tag.query.filter_by(_id=_id).one()  # type: Tag
-        return redirect(location=tag.remote_device.to_text())
+            form = 'cache'
+        metrics.RESOLUTIONS.inc(form)
+        metrics.DEVICEHUB_REQUESTS.inc(cached.devicehub, 'TagView.one')
+        response = redirect(location=cached.location)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config[
+            'TAG_FROZEN_MAX_AGE' if cached.frozen else 'TAG_REDIRECT_MAX_AGE'
+        ]
+        response.set_etag(cached.etag)
+        response.last_modified = cached.updated
+        return response.make_conditional(request)
 
     @auth.Auth.requires_auth
+    @metrics.REQUEST_DURATION.time('TagView.post')
     def post(self):
+        """
+        Creates ``num`` tags linked to the Devicehub of the user.
+
+        Returns the ids of the new tags as a JSON array or, if the
+        client accepts ``application/x-ndjson``, as one JSON string
+        per line. Ids are encoded while the response is streamed.
+        """
         num = request.args.get('num', type=int)
-        if not (0 < num <= 100):
-            raise UnprocessableEntity('Num must be a natural not greater than 100.')
-        tags = tuple(Tag(devicehub=g.user) for _ in range(num))
-        db.session.add_all(tags)
+        max_num = current_app.config['TAG_POST_MAX']
+        if not num or not (0 < num <= max_num):
+            raise UnprocessableEntity('Num must be a natural not greater than {}.'.format(max_num))
+        devicehub = g.user.to_text()
+        metrics.DEVICEHUB_REQUESTS.inc(devicehub, 'TagView.post', amount=num)
+        devicehub_id = Devicehub.id_of(g.user)
+        ids = [_id for ids in bulk.insert_tags(num, Tag.t, devicehub_id, commit=False)
+               for _id in ids]
+        for start, end in manufacturing.ranges(ids):
+            delivery.queue(devicehub_id, g.user, start, end)
         db.session.commit()
-        ids = tuple(tag.id for tag in tags)
-        response = jsonify(ids)
-        response.status_code = 201
+        if self.resource_def.lookup is not None:
+            self.resource_def.lookup.expire()
+        ndjson = request.accept_mimetypes.best_match((self.JSON, self.NDJSON)) == self.NDJSON
+        mimetype = self.NDJSON if ndjson else self.JSON
+        return Response(self.stream_ids(ids, ndjson), status=201, mimetype=mimetype)
+
+    def stream_ids(self, ids: List[int], ndjson: bool) -> Iterator[str]:
+        """Encodes and serializes ``ids`` by chunks."""
+        codec = self.resource_def.codec
+        if ndjson:
+            for chunk in chunked_iter(ids, bulk.CHUNK):
+                yield ''.join(json.dumps(id) + '\n' for id in codec.encode_many(chunk))
+        else:
+            yield '['
+            for i, chunk in enumerate(chunked_iter(ids, bulk.CHUNK)):
+                yield (',' if i else '') + ','.join(json.dumps(id) for id in codec.encode_many(chunk))
+            yield ']'
+
+
+class ResolveView(View):
+    @auth.Auth.requires_auth
+    @metrics.REQUEST_DURATION.time('ResolveView.post')
+    def post(self):
+        """
+        Resolves many Tag, ETag or secondary ids at once, for example
+        the ones of a pallet, instead of getting each tag.
+
+        Expects a JSON array of ids and returns an array with, for each
+        one, the ``id`` and either the ``url`` of the linked device or
+        an ``error`` like the ones of the API.
+
+        It takes the same queries whatever the number of ids.
+        """
+        ids = request.get_json()
+        max_num = current_app.config['TAG_RESOLVE_MAX']
+        if not isinstance(ids, list) or not all(isinstance(id, str) for id in ids) \
+                or len(ids) > max_num:
+            raise UnprocessableEntity('Send an array of up to {} ids.'.format(max_num))
+        candidates, errors = {}, {}  # type: Dict[str, List[int]], Dict[str, HTTPException]
+        for id in ids:
+            try:
+                candidates[id] = Tag.candidates(id)
+            except UnprocessableEntity as e:
+                errors[id] = e
+        found = {}
+        with current_app.resources['Tag'].replicas.session() as session:
+            if session is not None:
+                found = Tag.find_many(candidates, session)
+        missing = {id: c for id, c in candidates.items() if id not in found}
+        if missing:  # No replicas or the replica does not have them yet
+            found.update(Tag.find_many(missing))
+        templates = Devicehub.templates_of(tag.devicehub_id for tag in found.values()
+                                           if tag.devicehub_id is not None)
+        results = []
+        for id in ids:
+            tag = found.get(id)
+            if id in errors:
+                error = errors[id]
+            elif tag is None:
+                error = ResourceNotFound(Tag.t)
+            elif tag.devicehub_id is None:
+                metrics.NO_REMOTE_TAG.inc()
+                error = NoRemoteTag()
+            else:
+                devicehub, template, _ = templates[tag.devicehub_id]
+                metrics.RESOLUTIONS.inc('secondary' if tag.secondary == id else tag.type.lower())
+                metrics.DEVICEHUB_REQUESTS.inc(devicehub, 'ResolveView.post')
+                results.append({'id': id, 'url': template.format(tag.id)})
+                continue
+            results.append({'id': id, 'error': {
+                'message': error.description,
+                'code': error.code,
+                'type': error.__class__.__name__
+            }})
+        return Response(json.dumps(results), mimetype=TagView.JSON)
+
+
+class SecondaryView(View):
+    @auth.Auth.requires_auth
+    @metrics.REQUEST_DURATION.time('SecondaryView.post')
+    def post(self):
+        """
+        Sets the secondary ids, like the ids of NFC chips, of many
+        tags at once, as the ``set-secondaries`` command.
+
+        Expects a JSON array of pairs of Tag or ETag id and secondary
+        id. Only tags without Devicehub or of the Devicehub of the
+        user are set. Returns the number of tags ``set`` and the
+        ``rejected`` pairings with their ``id``, ``secondary`` and
+        ``problem``.
+        """
+        pairs = request.get_json()
+        max_num = current_app.config['TAG_SECONDARIES_MAX']
+        if not isinstance(pairs, list) or len(pairs) > max_num or not all(
+                isinstance(pair, list) and len(pair) == 2
+                and all(isinstance(value, str) for value in pair)
+                for pair in pairs):
+            raise UnprocessableEntity('Send an array of up to {} pairs of id and secondary id.'
+                                      .format(max_num))
+        ids, problems = bulk.set_secondaries(pairs, Tag.database_id,
+                                             devicehub_id=Devicehub.id_of(g.user))
+        invalidation.invalidate(db.session, ids)
+        db.session.commit()
+        rejected = [{'id': id, 'secondary': secondary, 'problem': problem}
+                    for _, id, secondary, problem in problems]
+        return Response(json.dumps({'set': len(ids), 'rejected': rejected}),
+                        mimetype=TagView.JSON)
+
+
+class LinkView(View):
+    @metrics.REQUEST_DURATION.time('LinkView.one')
+    def one(self, id):
+        """Redirects to the URL of the link."""
+        redirects = self.resource_def.redirects  # type: LRUCache
+        url = redirects.get(id)
+        if url is None:
+            url = Link.url_of(id)
+            if url is None:
+                raise ResourceNotFound(Link.t)
+            redirects.set(id, url)
+        response = redirect(location=url)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['TAG_FROZEN_MAX_AGE']
         return response
 
+    @auth.Auth.requires_auth
+    @metrics.REQUEST_DURATION.time('LinkView.post')
+    def post(self):
+        """
+        Creates links to the URLs of the JSON array in the body,
+        returning an array with their short URLs in the same order.
+        URLs that already have a link get the existing one.
+        """
+        urls = request.get_json()
+        max_num = current_app.config['TAG_LINKS_MAX']
+        if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls) \
+                or not 0 < len(urls) <= max_num:
+            raise UnprocessableEntity('Send an array of up to {} URLs.'.format(max_num))
+        try:
+            urls = [self.resource_def.normalize(url) for url in urls]
+        except ValueError as e:
+            raise UnprocessableEntity(str(e))
+        ids = [_id for _, ids in bulk.insert_links(urls, commit=False) for _id in ids]
+        db.session.commit()
+        short_urls = list(self.resource_def.urls(ids))
+        return Response(json.dumps(short_urls), status=201, mimetype=TagView.JSON)
+
 
 class VersionView(View):
     def get(self, *args, **kwargs):
         """Get version."""
 
         return json.dumps({'ereuse_tag': __version__})
+
+
+class MetricsView(View):
+    def get(self, *args, **kwargs):
+        """Get the metrics of this process in the Prometheus text
+        format.
+        """
+        redirects = current_app.resources['Tag'].redirects
+        metrics.REDIRECT_CACHE.set(redirects.hits, 'hits')
+        metrics.REDIRECT_CACHE.set(redirects.misses, 'misses')
+        metrics.REDIRECT_CACHE.set(len(redirects), 'size')
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -18,6 +18,9 @@ setup(
         'hashids',
         'teal>=0.2.0a34'
     ],
+    extras_require={
+        'asgi': ['asyncpg']
+    },
     tests_requires=[
         'pytest'
     ],